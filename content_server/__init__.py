@@ -2,34 +2,61 @@ import os
 from pathlib import Path
 from datetime import datetime, timedelta
 import hashlib
-from threading import Thread
+import json
+import functools
+import time
+from threading import Thread, Lock, Event, current_thread, main_thread
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
 import re
 import logging
 
-from flask import Flask, render_template, redirect, session, request
+from flask import Flask, Blueprint, render_template, redirect, session, \
+    request, jsonify, current_app, has_app_context, send_file, abort, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, not_, inspect, text, event, bindparam
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from content_server.queues import MemoryQueueStore
+from content_server.blobs import BlobStore
+from content_server.events import ChangeFeed
+from content_server.status import StatusIndex
+from content_server.cache import LRUCache
 
 __version__ = "0.2.1"
 
 app_folder = Path(__file__).absolute().parent
-cwd = os.getcwd()
 db_file_folder = "content_db"
+# Max seconds a long-poll request to /queue_get_pos is held
+long_poll_max_timeout = 60
+# Dashboard event streams are closed (and reconnected by the browser) after
+# event_stream_timeout seconds, with a heartbeat every event_stream_heartbeat
+event_stream_timeout = 300
+event_stream_heartbeat = 15
+# Max rows returned by a page of /api/contents
+api_max_page_length = 1000
 
-app = Flask(__name__)
-app.config.update(
-    SQLALCHEMY_DATABASE_URI="sqlite:///{}/{}/content.db".format(
-        cwd,
-        db_file_folder),
-    SQLALCHEMY_TRACK_MODIFICATIONS=False,
-    SECRET_KEY=b"_5#y2L'F4Q8z\n\xec]/")
-
-db = SQLAlchemy(app)
+# Opt-in SQLite tuning for concurrent readers and writers, applied to every
+# new connection by ContentServer(db_profile="performance")
+sqlite_performance_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 10000,
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY"
+}
+sqlite_performance_engine_options = {
+    "poolclass": QueuePool,
+    "pool_size": 16,
+    "max_overflow": 16,
+    "connect_args": {"check_same_thread": False, "timeout": 10}
+}
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)8s]"
-                                               " - %(name)s - %(message)s")
-_log = logging.getLogger('werkzeug')
-_log.setLevel(logging.ERROR)
-app.logger.setLevel(logging.ERROR)
+# Bound to the APP of each ContentServer by create_app()
+db = SQLAlchemy()
 
 
 class UID(db.Model):
@@ -49,18 +76,41 @@ class UID(db.Model):
     
 class Content(db.Model):
     __tablename__ = "content"
+    __table_args__ = (
+        # Queue state of a Service (pending/terminal entries)
+        db.Index("ix_content_service_name_queue_pos",
+                 "service_name",
+                 "queue_pos"),
+        # Enqueue order of a Service
+        db.Index("ix_content_service_name_queue_seq",
+                 "service_name",
+                 "queue_seq"),
+        # Never reuse the ids of deleted contents (they are kept in memory,
+        # e.g. by the request_key index)
+        {"sqlite_autoincrement": True},
+    )
     content_id = db.Column(db.Integer, primary_key=True, nullable=False)
     service_name = db.Column(db.String(32), default="")
     rpc_method = db.Column(db.String(32), default="")
     message = db.Column(db.String(32), default="")
     queue_pos = db.Column(db.Integer, nullable=False)
-    expiration = db.Column(db.DateTime)
-    creation = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # Enqueue sequence in the Service Queue, to rebuild it after a restart
+    queue_seq = db.Column(db.Integer)
+    # Higher priorities are processed first
+    priority = db.Column(db.Integer, default=0)
+    expiration = db.Column(db.DateTime, index=True)
+    creation = db.Column(db.DateTime, nullable=False, default=datetime.now,
+                         index=True)
     content_type = db.Column(db.String(10), default="text")
     content = db.Column(db.String(4096), default=None)
+    # Key of the content in the BlobStore when it is too large to be inline
+    content_ref = db.Column(db.String(64), default=None, index=True)
+    # Content whose job produces the result of this one (see add())
+    source_id = db.Column(db.Integer, default=None, index=True)
     content_uid = db.Column(db.String(20),
                             db.ForeignKey('uid.uid'),
-                            nullable=False)
+                            nullable=False,
+                            index=True)
     
     def __repr__(self):
         return "id: {}\n" \
@@ -78,108 +128,521 @@ class Content(db.Model):
                                     self.content)
 
 
+class Job(namedtuple("Job", ["content_id",
+                             "content_uid",
+                             "service_name",
+                             "rpc_method",
+                             "message",
+                             "queue_pos",
+                             "priority",
+                             "expiration",
+                             "creation",
+                             "content_type",
+                             "content",
+                             "content_ref",
+                             "source_id"])):
+    """
+    Read-only record of a Content entry (same attributes), loaded by column
+    instead of as an ORM instance, for the cache of get_job() and the
+    Dashboard views
+    """
+    __slots__ = ()
+
+    @classmethod
+    def select(cls, *criteria):
+        """ Column query of the entries matching criteria, rows are Jobs """
+        return db.session.query(
+            *[getattr(Content, field) for field in cls._fields]
+        ).filter(*criteria)
+
+
+def _app_context(method):
+    """ Run a ContentServer method within the context of its own APP """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if has_app_context() and current_app._get_current_object() is self.app:
+            return method(self, *args, **kwargs)
+        with self.app.app_context():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ContentServer:
     def __init__(self, host="localhost", port=7000,
-                 admin_pwd="admin", queues=None, log=None):
+                 admin_pwd="admin", queues=None, queue_store=None,
+                 workers=None, fair_share=False, uid_weights=None,
+                 sweep_interval=None, sweep_batch_size=1000, config=None,
+                 db_profile=None, flush_interval=None, flush_size=100,
+                 blob_store=None, result_cache_size=10000,
+                 result_cache_ttl=3600, cache_size=10000, cache_ttl=60,
+                 log=None):
         self.host = host
         self.port = port
         self.admin_pwd = admin_pwd
+
+        # Each Dashboard event stream holds a server thread, past
+        # max_event_streams open streams the Dashboards get a 503 and retry
+        # later (0 disables them). None is no limit, serve() sets it from
+        # the threads of its engine.
+        self.max_event_streams = None
+        # Each /queue_get_pos long-poll also holds a thread, past
+        # max_long_polls waiting requests the others get their position
+        # right away. None is no limit, also set by serve().
+        self.max_long_polls = None
+        self._long_polls = 0
+        self._long_polls_lock = Lock()
+
+        # Each ContentServer owns its Flask APP and DB engine/sessions.
+        # config updates the APP config, e.g. SQLALCHEMY_DATABASE_URI and
+        # SQLALCHEMY_ENGINE_OPTIONS (pool settings).
+        # db_profile="performance" tunes a SQLite DB for concurrent access.
+        self.app = create_app(self, config, db_profile)
         
-        self.queues = dict()
-        if queues:
-            self.queues = queues
+        # Service Queues, in memory by default, a dict of
+        # {service_name: [content_id, ...]} can be passed to restore a
+        # previous state. A shared QueueStore (e.g. SQLQueueStore or
+        # RedisQueueStore) lets many processes serve the same Queues.
+        if queue_store is None:
+            queue_store = MemoryQueueStore(queues)
+        self.queues = queue_store
+
+        # Number of jobs processed at the same time per Service (default 1),
+        # e.g. {"service_name": 4}, merged into the slots of the QueueStore.
+        # The func of a job passed to add() only runs when the job has one
+        # of these slots.
+        self.queues.slots.update(workers or {})
+        self.workers = self.queues.slots
+
+        # Jobs are queued by priority (see add()) and then FIFO. With
+        # fair_share the UIDs of a Service take turns (uid_weights gives a
+        # UID more jobs per turn, {"uid": 2}), so a UID with many jobs does
+        # not hold back the others. Only in-process QueueStores support it.
+        if fair_share and self.queues.shared:
+            raise ValueError("fair_share needs an in-process QueueStore")
+        if fair_share:
+            self.queues.fair_share = True
+        self.queues.weights.update(uid_weights or {})
+
+        # Per Service executors and the funcs waiting for their turn
+        self._executors = dict()
+        self._funcs = dict()
+        self._dispatch_lock = Lock()
+        self._dispatcher = None
+
+        # Expired contents (and UIDs left without contents) are purged every
+        # sweep_interval seconds by serve(), None disables it.
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        self.sweep_stats = {"runs": 0, "contents": 0, "uids": 0,
+                            "blobs": 0, "last_run": None}
+        self._sweeper = None
+        self._sweeper_stop = Event()
+
+        # Write-behind buffer of update(), None writes every call.
+        # With flush_interval (seconds) the updates of a content are merged
+        # and written together every flush_interval or once flush_size
+        # contents are pending. Ready/Error states are never delayed.
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = dict()
+        self._pending_lock = Lock()
+        self._flush_lock = Lock()
+        self._flusher = None
+
+        # Large contents (see BlobStore.inline_limit) are stored as files,
+        # next to the SQLite DB by default (see blob_folder()), other DBs
+        # keep them inline and need a blob_store for larger ones
+        self.blobs = blob_store or BlobStore(
+            blob_folder(self.app.config["SQLALCHEMY_DATABASE_URI"]))
+
+        # Index of the jobs added with a request_key, a LRU of
+        # {(service_name, rpc_method, request_key): (content_id, ready_at)}
+        # with at most result_cache_size entries. Ready results are reused
+        # for result_cache_ttl seconds (and until they expire).
+        self.result_cache_size = result_cache_size
+        self.result_cache_ttl = result_cache_ttl
+        self._results = OrderedDict()
+        # Reverse indexes {content_id: key} of the pending jobs and of
+        # every job in _results
+        self._result_keys = dict()
+        self._result_ids = dict()
+        # Contents linked to a pending job {content_id: source_id} and
+        # the reverse {source_id: {content_id, ...}}
+        self._links = dict()
+        self._waiters = dict()
+        # (func, args) of the linked contents, run if they are promoted
+        self._linked_funcs = dict()
+        self._cache_lock = Lock()
+
+        # Changes of the contents, streamed to the Dashboard (/api/events)
+        # and indexed to validate /status polls without the DB
+        self.feed = ChangeFeed()
+        self.status = StatusIndex()
+        self.feed.listeners.append(self.status)
+        self.feed.listeners.append(self._forget_results)
+
+        # Read-through caches of uid_exists() and get_job(),
+        # invalidated by the writes of this process (see their stats).
+        # Writes of other processes are seen after cache_ttl seconds.
+        self.uid_cache = LRUCache(cache_size, cache_ttl)
+        self.content_cache = LRUCache(cache_size, cache_ttl)
+        self.feed.listeners.append(self._invalidate_cache)
 
         self.log = log
 
     # ========================= DB Methods ====================================
-    @staticmethod
-    def create(drop=False):
-        if not os.path.exists(db_file_folder):
-            os.makedirs(db_file_folder)
-        elif drop:
+    @_app_context
+    def create(self, drop=False):
+        db_path = sqlite_path(self.app.config["SQLALCHEMY_DATABASE_URI"])
+        if db_path:
+            folder = os.path.dirname(db_path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+        if drop:
             db.drop_all()
+            self.uid_cache.clear()
+            self.content_cache.clear()
         db.create_all()
+        ContentServer.migrate()
+        self.restore_queues()
 
     @staticmethod
-    def query_all_uid():
+    def migrate(bind=None):
+        """
+        Bring an existing DB to the current schema.
+        create_all() skips tables that already exist, so columns and indexes
+        added after a content.db was created are created here.
+        """
+        if bind is None:
+            with db.engine.begin() as conn:
+                return ContentServer.migrate(conn)
+        inspector = inspect(bind)
+        for table in db.metadata.sorted_tables:
+            columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    bind.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        table.name,
+                        column.name,
+                        column.type.compile(bind.dialect))))
+            for index in table.indexes:
+                index.create(bind=bind, checkfirst=True)
+
+    @_app_context
+    def restore_queues(self):
+        """
+        Rebuild the Service Queues from the pending entries of the DB
+        with a single ordered query.
+        Entries stored before queue_seq existed come first, by content_id.
+        Shared QueueStores keep their own state and are left as they are.
+        Entries linked to a pending job (see add()) wait for it again.
+        """
+        links = db.session.query(Content.content_id,
+                                 Content.source_id).filter(
+            Content.queue_pos >= 0,
+            Content.source_id.isnot(None))
+        with self._cache_lock:
+            for row in links:
+                self._links[row.content_id] = row.source_id
+                self._waiters.setdefault(row.source_id,
+                                         set()).add(row.content_id)
+        if self.queues.shared:
+            return
+        rows = db.session.query(Content.service_name,
+                                Content.content_id,
+                                Content.queue_seq,
+                                Content.priority,
+                                Content.content_uid).filter(
+            Content.queue_pos >= 0,
+            Content.source_id.is_(None)).order_by(
+            Content.service_name,
+            Content.queue_seq.nullsfirst(),
+            Content.content_id)
+        self.queues.extend([(row.service_name, row.content_id, row.queue_seq,
+                             row.priority, row.content_uid) for row in rows])
+
+    @_app_context
+    def query_all_uid(self):
         return UID.query.all()
 
-    @staticmethod
-    def query_one_uid(uid):
+    @_app_context
+    def query_one_uid(self, uid):
         return UID.query.filter_by(uid=uid).first()
 
-    @staticmethod
-    def query_all_content(uid):
+    def uid_exists(self, uid):
+        """ Return whether a UID exists (cached) """
+        return self.uid_cache.get(uid, lambda: self._uid_exists(uid))
+
+    @_app_context
+    def _uid_exists(self, uid):
+        return db.session.query(UID.uid).filter_by(uid=uid).first() \
+            is not None
+
+    @_app_context
+    def query_all_content(self, uid):
         return Content.query.filter_by(content_uid=uid).all()
     
-    @staticmethod
-    def query_one_content(content_id):
+    @_app_context
+    def query_one_content(self, content_id):
         return Content.query.filter_by(content_id=content_id).first()
+
+    def get_job(self, content_id):
+        """
+        Return the Job record of a Content entry (cached), read-only, use
+        query_one_content() for the ORM entry. Changes not made through
+        the ContentServer methods are seen after cache_ttl seconds.
+        """
+        return self.content_cache.get(
+            content_id, lambda: self._load_content(content_id))
+
+    @_app_context
+    def _load_content(self, content_id):
+        row = Job.select(Content.content_id == content_id).first()
+        return Job._make(row) if row is not None else None
+
+    def _invalidate_cache(self, kind, content_ids, uid, service_name):
+        """ ChangeFeed listener """
+        if kind == "add":
+            self.uid_cache.set(uid, True)
+        for content_id in content_ids:
+            self.content_cache.invalidate(content_id)
     
+    @_app_context
     def add(self, uid=None, service_name="test_service", rpc_method=None,
-            message=None, content_type=None, func=None, args=None):
-        while not uid:
+            message=None, content_type=None, func=None, args=None,
+            request_key=None, priority=0):
+        """
+        Add a job to the Queue of service_name, before the jobs with a lower
+        priority.
+        Jobs with a request_key (e.g. request_hash(args)) are idempotent:
+        when the same (service_name, rpc_method, request_key) has a Ready
+        result (not expired, see result_cache_ttl) or a pending job, the new
+        entry is linked to it instead of being queued, its func is not run
+        and it gets the result of that job. If that job is removed, the
+        first entry linked to it is queued (and its func run) instead.
+        """
+        source = None
+        if request_key is not None:
+            source = self._cached_request(
+                (service_name, rpc_method, request_key))
+
+        new_uid = not uid
+        if new_uid:
             uid = self._generate_uid()
-            entry = self.query_one_uid(uid)
-            if entry:
-                uid = None
 
         if self.log:
             self.log.info("Adding content: {} {}".format(uid, rpc_method))
         
-        entry = self.query_one_uid(uid)
-        if not entry:
-            entry = UID(uid=uid)
-
-        if service_name not in self.queues:
-            self.queues[service_name] = []
-            
-        content = Content(service_name=service_name,
-                          rpc_method=rpc_method,
-                          message=message,
-                          queue_pos=len(self.queues[service_name]),
-                          content_type=content_type)
-
-        entry.contents.append(content)
-        db.session.add(entry)
+        if new_uid or not self.uid_exists(uid):
+            db.session.add(UID(uid=uid))
+
+        if source is None:
+            content = Content(content_uid=uid,
+                              service_name=service_name,
+                              rpc_method=rpc_method,
+                              message=message,
+                              queue_pos=self.queues.size(service_name),
+                              queue_seq=self.queues.reserve(service_name),
+                              priority=priority,
+                              content_type=content_type)
+        else:
+            content = Content(content_uid=uid,
+                              service_name=service_name,
+                              rpc_method=rpc_method,
+                              message=message,
+                              queue_pos=source.queue_pos,
+                              priority=priority,
+                              content_type=source.content_type,
+                              source_id=source.content_id)
+            self._copy_result(source, content)
+
+        db.session.add(content)
         db.session.commit()
 
-        self.queues[service_name].append(content.content_id)
+        if source is not None:
+            if content.queue_pos >= 0:
+                self._link(content.content_id, source.content_id,
+                           (func, args) if func else None)
+            self.feed.publish("add", [content.content_id], uid, service_name)
+            return uid, content.content_id
+
+        self.queues.append(service_name, content.content_id, content.queue_seq,
+                           priority, uid)
+        self.feed.publish("add", [content.content_id], uid, service_name)
+
+        if request_key is not None:
+            self._cache_request((service_name, rpc_method, request_key),
+                                content.content_id)
 
         if func:
-            res_th = Thread(target=func,
-                            daemon=True,
-                            args=(uid, content.content_id, rpc_method, ),
-                            kwargs=args)
-            res_th.start()
+            self._start_func(func, uid, content.content_id, rpc_method, args,
+                             service_name)
         
         return uid, content.content_id
+
+    @_app_context
+    def add_many(self, jobs, uid=None):
+        """
+        Add a batch of entries in a single transaction.
+        Each job is a dict with the same keys as add(), jobs without an "uid"
+        use the uid argument (or a new UID shared by the whole batch).
+        Return a list of (uid, content_id) in the same order as jobs.
+        """
+        if not jobs:
+            return []
+
+        new_uid = None
+        if not uid and any(not job.get("uid", None) for job in jobs):
+            uid = new_uid = self._generate_uid()
+
+        if self.log:
+            self.log.info("Adding {} contents: {}".format(len(jobs), uid))
+
+        uids = {job.get("uid", None) or uid for job in jobs}
+        uids.discard(new_uid)
+        existing = {row.uid for row in
+                    UID.query.filter(UID.uid.in_(list(uids))).all()}
+        if new_uid:
+            uids.add(new_uid)
+
+        sizes = dict()
+        mappings = []
+        for job in jobs:
+            service_name = job.get("service_name", "test_service")
+            if service_name not in sizes:
+                sizes[service_name] = self.queues.size(service_name)
+            mappings.append({
+                "content_uid": job.get("uid", None) or uid,
+                "service_name": service_name,
+                "rpc_method": job.get("rpc_method", None),
+                "message": job.get("message", None),
+                "queue_pos": sizes[service_name],
+                "queue_seq": self.queues.reserve(service_name),
+                "priority": job.get("priority", 0),
+                "content_type": job.get("content_type", None)
+            })
+            sizes[service_name] += 1
+
+        db.session.bulk_insert_mappings(
+            UID, [{"uid": u} for u in uids if u not in existing])
+        db.session.bulk_insert_mappings(Content, mappings,
+                                        return_defaults=True)
+        db.session.commit()
+
+        self.queues.extend([(m["service_name"],
+                             m["content_id"],
+                             m["queue_seq"],
+                             m["priority"],
+                             m["content_uid"]) for m in mappings])
+        added = dict()
+        for m in mappings:
+            added.setdefault((m["content_uid"], m["service_name"]),
+                             []).append(m["content_id"])
+        for (content_uid, service_name), content_ids in added.items():
+            self.feed.publish("add", content_ids, content_uid, service_name)
+
+        for job, m in zip(jobs, mappings):
+            if job.get("func", None):
+                self._start_func(job["func"],
+                                 m["content_uid"],
+                                 m["content_id"],
+                                 m["rpc_method"],
+                                 job.get("args", None),
+                                 m["service_name"])
+
+        return [(m["content_uid"], m["content_id"]) for m in mappings]
     
+    @_app_context
     def update(self, content_id, queue_pos=0,
                message=None, expiration=None, content=None):
         if self.log:
             self.log.info("Updating content: {} Queue: {}".format(content_id,
                                                                   queue_pos))
 
-        c = self.query_one_content(content_id)
-        if c:
-            c.queue_pos = queue_pos
-            # Error
-            if queue_pos == -2:
-                c.expiration = None
-            elif expiration:
-                c.expiration = datetime.now() + self._get_delta_str(expiration)
-
-            if message:
-                c.message = message
-            if content:
-                c.content = content
-                
+        values = {"queue_pos": queue_pos}
+        # Error
+        if queue_pos == -2:
+            values["expiration"] = None
+        elif expiration:
+            values["expiration"] = datetime.now() + \
+                self._get_delta_str(expiration)
+
+        if message:
+            values["message"] = message
+        if content:
+            values.update(self.blobs.store(content))
+
+        done = queue_pos == -1 or queue_pos == -2
+
+        if self.flush_interval is None:
+            Content.query.filter_by(content_id=content_id).update(
+                values, synchronize_session=False)
             db.session.commit()
-            
-            if queue_pos == -1 or queue_pos == -2:
-                self.queue_rem_pos(content_id)
-    
+            self.feed.publish("update", [content_id])
+        else:
+            # Coalesce with the buffered changes of this content, the final
+            # states (Ready/Error) are written right away with the others.
+            with self._pending_lock:
+                self._pending.setdefault(content_id, dict()).update(values)
+                full = len(self._pending) >= self.flush_size
+                if not self._flusher:
+                    self._flusher = Thread(target=self._flush_loop,
+                                           daemon=True)
+                    self._flusher.start()
+            if done or full:
+                self.flush()
+
+        if done:
+            self._finish_request(content_id, queue_pos)
+            self.queue_rem_pos(content_id)
+
+    @_app_context
+    def flush(self):
+        """
+        Write the buffered updates (see flush_interval) in a single
+        transaction, one UPDATE statement per set of changed columns.
+        On errors they are buffered again for the next flush.
+        Return the number of contents written.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, dict()
+            if not pending:
+                return 0
+            groups = dict()
+            for content_id, values in pending.items():
+                row = dict(values, _content_id=content_id)
+                groups.setdefault(tuple(sorted(values)), []).append(row)
+            table = Content.__table__
+            try:
+                for columns, rows in groups.items():
+                    db.session.execute(
+                        table.update().where(
+                            table.c.content_id == bindparam("_content_id")
+                        ).values({c: bindparam(c) for c in columns}),
+                        rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Keep the updates buffered since the swap over these ones
+                with self._pending_lock:
+                    for content_id, values in pending.items():
+                        values.update(self._pending.get(content_id, {}))
+                        self._pending[content_id] = values
+                raise
+        self.feed.publish("update", pending)
+        return len(pending)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                if self.log:
+                    self.log.error("Flush failed: {}".format(e))
+
+    @_app_context
     def remove(self, uid=None, content_id=None):
         if self.log:
             self.log.info("Removing content: {}".format(content_id))
@@ -187,27 +650,371 @@ class ContentServer:
         # Remove the UID with all its contents
         if uid:
             entry = self.query_one_uid(uid)
-            db.session.delete(entry)
-            db.session.commit()
-            for content_id in self.query_all_content(uid):
-                self.queue_rem_pos(content_id)
+            if entry:
+                content_ids = [c.content_id for c in entry.contents]
+                db.session.delete(entry)
+                db.session.commit()
+                self.uid_cache.invalidate(uid)
+                self.feed.publish("remove", content_ids)
+                for content_id in content_ids:
+                    self._finish_request(content_id, -2, removed=True)
+                    self.queue_rem_pos(content_id)
         # Else remove just the target content
         elif content_id:
-            content = self.query_one_content(content_id)
+            content = Content.query.filter_by(content_id=content_id).first()
             if content:
                 db.session.delete(content)
                 db.session.commit()
+                self.feed.publish("remove", [content_id])
+            self._finish_request(content_id, -2, removed=True)
             self.queue_rem_pos(content_id)
 
+    @_app_context
+    def sweep(self, batch_size=None):
+        """
+        Delete the expired contents and the UIDs left without contents,
+        in transactions of at most batch_size rows. Contents still in a
+        Queue are kept until they leave it.
+        Return the number of (contents, uids) deleted.
+        """
+        batch_size = batch_size or self.sweep_batch_size
+        now = datetime.now()
+        contents = uids = 0
+        while True:
+            content_ids = [row.content_id for row in db.session.query(
+                Content.content_id).filter(
+                Content.expiration <= now,
+                Content.queue_pos < 0).order_by(
+                Content.expiration).limit(batch_size)]
+            if not content_ids:
+                break
+            Content.query.filter(
+                Content.content_id.in_(content_ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+            self.feed.publish("remove", content_ids)
+            contents += len(content_ids)
+            if len(content_ids) < batch_size:
+                break
+        while True:
+            orphans = [row.uid for row in db.session.query(UID.uid).filter(
+                ~UID.contents.any()).limit(batch_size)]
+            if not orphans:
+                break
+            UID.query.filter(UID.uid.in_(orphans)).delete(
+                synchronize_session=False)
+            db.session.commit()
+            for orphan in orphans:
+                self.uid_cache.invalidate(orphan)
+            uids += len(orphans)
+            if len(orphans) < batch_size:
+                break
+        blobs = self.sweep_blobs(batch_size)
+
+        self.sweep_stats["runs"] += 1
+        self.sweep_stats["contents"] += contents
+        self.sweep_stats["uids"] += uids
+        self.sweep_stats["blobs"] += blobs
+        self.sweep_stats["last_run"] = now
+        if self.log and (contents or uids or blobs):
+            self.log.info("Sweep: {} contents, {} uids and {} blobs "
+                          "purged".format(contents, uids, blobs))
+        return contents, uids
+
+    @_app_context
+    def sweep_blobs(self, batch_size=None):
+        """
+        Delete the blobs no Content references anymore, skipping the ones
+        written in the last BlobStore.grace seconds (their Content may not
+        be committed yet). Return the number of blobs deleted.
+        """
+        batch_size = batch_size or self.sweep_batch_size
+        keys = self.blobs.keys(older_than=self.blobs.grace)
+        deleted = 0
+        while True:
+            batch = [key for _, key in zip(range(batch_size), keys)]
+            if not batch:
+                break
+            used = {row.content_ref for row in db.session.query(
+                Content.content_ref).filter(
+                Content.content_ref.in_(batch)).distinct()}
+            for key in batch:
+                if key not in used:
+                    self.blobs.delete(key)
+                    deleted += 1
+        return deleted
+
+    @staticmethod
+    def request_hash(*args, **kwargs):
+        """ Return a request_key (sha256) of JSON serializable arguments """
+        m = hashlib.sha256()
+        m.update(json.dumps([args, kwargs], sort_keys=True,
+                            default=str).encode("utf-8"))
+        return m.hexdigest()
+
+    def _cached_request(self, key):
+        """ Return the Job of a reusable job of key, None if missing """
+        with self._cache_lock:
+            entry = self._results.get(key, None)
+            if entry is None:
+                return None
+            self._results.move_to_end(key)
+            content_id, ready_at = entry
+        source = self.get_job(content_id)
+        # None is stored as "" (the column defaults)
+        if source is not None and \
+                ((source.service_name or None), (source.rpc_method or None)) \
+                != ((key[0] or None), (key[1] or None)):
+            source = None
+        elif ready_at is not None and \
+                time.time() - ready_at > self.result_cache_ttl:
+            source = None
+        elif source is not None and (source.queue_pos == -2 or (
+                source.expiration and source.expiration <= datetime.now())):
+            source = None
+        if source is None:
+            with self._cache_lock:
+                if self._results.get(key, None) == entry:
+                    self._drop_result(key)
+        return source
+
+    def _cache_request(self, key, content_id):
+        with self._cache_lock:
+            self._set_result(key, content_id)
+            self._result_keys[content_id] = key
+
+    def _set_result(self, key, content_id, ready_at=None):
+        """ Index the job of key (with _cache_lock) """
+        if key in self._results:
+            self._result_ids.pop(self._results[key][0], None)
+        self._results[key] = (content_id, ready_at)
+        self._results.move_to_end(key)
+        self._result_ids[content_id] = key
+        while len(self._results) > self.result_cache_size:
+            self._result_ids.pop(self._results.popitem(last=False)[1][0],
+                                 None)
+
+    def _drop_result(self, key):
+        """ Forget the job of key (with _cache_lock) """
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self._result_ids.pop(entry[0], None)
+
+    def _forget_results(self, kind, content_ids, uid, service_name):
+        """ ChangeFeed listener, deleted contents are not reusable """
+        if kind != "remove":
+            return
+        with self._cache_lock:
+            for content_id in content_ids:
+                key = self._result_ids.get(content_id, None)
+                if key is not None:
+                    self._drop_result(key)
+
+    def _link(self, content_id, source_id, func=None):
+        """ Make a content wait for the result of a pending job """
+        with self._cache_lock:
+            if source_id in self._result_keys:
+                self._links[content_id] = source_id
+                self._waiters.setdefault(source_id, set()).add(content_id)
+                if func:
+                    self._linked_funcs[content_id] = func
+                return
+        # The job finished in the meantime
+        self._resolve_links(source_id, [content_id])
+
+    def _finish_request(self, content_id, queue_pos, removed=False):
+        """
+        Keep (Ready) or drop the result of a job and resolve its links,
+        a removed job hands them over to one of the linked contents
+        """
+        with self._cache_lock:
+            key = self._result_keys.pop(content_id, None)
+            entry = self._results.get(key, None)
+            if entry is not None and entry[0] == content_id:
+                if queue_pos == -1:
+                    self._results[key] = (content_id, time.time())
+                else:
+                    self._drop_result(key)
+            source_id = self._links.pop(content_id, None)
+            if source_id in self._waiters:
+                self._waiters[source_id].discard(content_id)
+            self._linked_funcs.pop(content_id, None)
+            waiters = self._waiters.pop(content_id, None)
+            for waiter in waiters or []:
+                self._links.pop(waiter, None)
+                if not removed:
+                    self._linked_funcs.pop(waiter, None)
+        if waiters and removed:
+            self._promote(key, list(waiters))
+        elif waiters:
+            self._resolve_links(content_id, list(waiters))
+
+    @_app_context
+    def _promote(self, key, content_ids):
+        """
+        Queue the first of the contents linked to a removed job in its
+        place (with its func and request_key), the others wait for it
+        """
+        rows = Job.select(Content.content_id.in_(content_ids),
+                          Content.queue_pos >= 0).order_by(
+            Content.content_id).all()
+        if not rows:
+            return
+        job, others = rows[0], [row.content_id for row in rows[1:]]
+        seq = self.queues.reserve(job.service_name)
+        Content.query.filter_by(content_id=job.content_id).update(
+            {"source_id": None,
+             "queue_seq": seq,
+             "queue_pos": self.queues.size(job.service_name)},
+            synchronize_session=False)
+        if others:
+            Content.query.filter(Content.content_id.in_(others)).update(
+                {"source_id": job.content_id}, synchronize_session=False)
+        db.session.commit()
+
+        with self._cache_lock:
+            if key is not None and key not in self._results:
+                self._set_result(key, job.content_id)
+                self._result_keys[job.content_id] = key
+            for other in others:
+                self._links[other] = job.content_id
+            if others:
+                self._waiters[job.content_id] = set(others)
+            func = self._linked_funcs.pop(job.content_id, None)
+        self.queues.append(job.service_name, job.content_id, seq,
+                           job.priority, job.content_uid)
+        self.feed.publish("update", [row.content_id for row in rows])
+        self.feed.publish("queue", service_name=job.service_name)
+        if func:
+            self._start_func(func[0], job.content_uid, job.content_id,
+                             job.rpc_method, func[1], job.service_name)
+
+    @_app_context
+    def _resolve_links(self, source_id, content_ids):
+        """ Give the result of a finished job to the contents linked to it """
+        source = self.get_job(source_id)
+        values = {"queue_pos": -2, "expiration": None}
+        if source is not None:
+            values = self._copy_result(source, dict())
+            values["queue_pos"] = source.queue_pos
+        Content.query.filter(Content.content_id.in_(content_ids),
+                             Content.queue_pos >= 0).update(
+            values, synchronize_session=False)
+        db.session.commit()
+        self.feed.publish("update", content_ids)
+
+    @staticmethod
+    def _copy_result(source, target):
+        """ Copy the result columns of source to target (Content or dict) """
+        for column in ("message", "expiration", "content", "content_ref"):
+            value = getattr(source, column)
+            if isinstance(target, dict):
+                target[column] = value
+            elif value is not None:
+                setattr(target, column, value)
+        return target
+
+    def read_content(self, content):
+        """ Return the content (str or bytes) of a Content entry (or Job) """
+        if content.content_ref:
+            return self.blobs.read(content.content_ref)
+        return content.content
+
+    def start_sweeper(self, interval=None):
+        """ Run sweep() every interval seconds in a background thread """
+        if interval:
+            self.sweep_interval = interval
+        if not self.sweep_interval or self._sweeper:
+            return
+        self._sweeper_stop.clear()
+        self._sweeper = Thread(target=self._sweep_loop, daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._sweeper_stop.set()
+        if self._sweeper:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def _sweep_loop(self):
+        while not self._sweeper_stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                if self.log:
+                    self.log.error("Sweep failed: {}".format(e))
+
     # =========================================================================
 
+    def _start_func(self, func, uid, content_id, rpc_method, args,
+                    service_name):
+        """ Register the func of a job, it runs once the job has its turn """
+        with self._dispatch_lock:
+            self._funcs[content_id] = (func, uid, rpc_method, args,
+                                       service_name)
+            # Other processes can move a shared Queue, so it is polled
+            if self.queues.shared and not self._dispatcher:
+                self._dispatcher = Thread(target=self._dispatch_loop,
+                                          daemon=True)
+                self._dispatcher.start()
+        self._dispatch(service_name)
+
+    def _dispatch_loop(self):
+        while True:
+            time.sleep(self.queues.poll_interval)
+            with self._dispatch_lock:
+                service_names = {f[-1] for f in self._funcs.values()}
+            for service_name in service_names:
+                try:
+                    self._dispatch(service_name)
+                except Exception as e:
+                    if self.log:
+                        self.log.error("Dispatch failed: {}".format(e))
+
+    def _dispatch(self, service_name):
+        """ Submit the funcs of the jobs that have their turn """
+        futures = []
+        with self._dispatch_lock:
+            if not self._funcs:
+                return
+            for content_id in self.queues.head(service_name):
+                if content_id not in self._funcs:
+                    continue
+                func, uid, rpc_method, args, _ = self._funcs.pop(content_id)
+                if service_name not in self._executors:
+                    self._executors[service_name] = ThreadPoolExecutor(
+                        max_workers=self.workers.get(service_name, 1),
+                        thread_name_prefix=service_name)
+                future = self._executors[service_name].submit(
+                    func, uid, content_id, rpc_method, **(args or {}))
+                futures.append((content_id, future))
+        # Out of the lock, the callbacks of finished funcs run right away
+        for content_id, future in futures:
+            future.add_done_callback(
+                functools.partial(self._func_done, content_id))
+
+    def _func_done(self, content_id, future):
+        """ A func that failed sets its job to Error if it is still queued """
+        if not future.exception():
+            return
+        if self.log:
+            self.log.error("Job func failed: {}".format(future.exception()))
+        if self.queues.get_pos(content_id) >= 0:
+            try:
+                self.update(content_id, queue_pos=-2)
+            except Exception as e:
+                if self.log:
+                    self.log.error("Job func cleanup failed: {}".format(e))
+
     @staticmethod
     def _generate_uid():
-        m = hashlib.sha256()
-        m.update(str(datetime.now()).encode("utf-8"))
-        m = m.digest().hex()
-        # Get only the first and the last 10 hex
-        return m[:10] + m[-10:]
+        """
+        Return a new UID of 20 hex chars (80 random bits from os.urandom),
+        unique across threads and processes with no DB check (a collision
+        is expected after ~10^12 UIDs). UIDs log into the Dashboard, so they
+        are random instead of time/counter based, which could be guessed.
+        """
+        return os.urandom(10).hex()
     
     @staticmethod
     def _get_delta_str(time_str):
@@ -229,239 +1036,885 @@ class ContentServer:
 
     # ============================ Queue Methods ==============================
     def queue_get_pos(self, content_id):
-        """ Return the position of item in the Queue of a Service """
-        for k, v in self.queues.items():
-            if content_id in v:
-                return self.queues[k].index(content_id)
-        return -1
+        """
+        Return the position of item in the Queue of a Service
+        (of the job it is linked to, see add())
+        """
+        return self.queues.get_pos(self._links.get(content_id, content_id))
+
+    def wait_for_turn(self, content_id, timeout=None):
+        """
+        Block until the item has its turn: its position is lower than the
+        number of workers of its Service (1 by default, so position 0).
+        Return its position, -1 if it left the Queue. If timeout (seconds)
+        expires first the returned position is still out of turn.
+        """
+        return self.queues.wait(self._links.get(content_id, content_id),
+                                timeout)
+
+    def long_poll_turn(self, content_id, timeout):
+        """
+        wait_for_turn() of the /queue_get_pos long-polls, past
+        max_long_polls waiting requests it does not wait
+        """
+        with self._long_polls_lock:
+            if self.max_long_polls is not None and \
+                    self._long_polls >= self.max_long_polls:
+                timeout = 0
+            self._long_polls += 1
+        try:
+            if not timeout:
+                return self.queue_get_pos(content_id)
+            return self.wait_for_turn(content_id, timeout)
+        finally:
+            with self._long_polls_lock:
+                self._long_polls -= 1
 
     def queue_update(self):
-        """ Update all positions in the Queue """
+        """
+        Write all current positions of the Queue to the DB.
+        Not needed to read positions (see content_queue_pos()), only to keep
+        the stored queue_pos column in sync for external DB readers.
+        """
         for k, v in self.queues.items():
-            for content_id in self.queues[k]:
+            for content_id in list(v):
                 self.update(content_id,
                             queue_pos=self.queue_get_pos(content_id))
 
     def queue_rem_pos(self, content_id):
         """ Remove an item from the Queue """
-        for k, v in self.queues.items():
-            if content_id in v:
-                self.queues[k].pop(self.queues[k].index(content_id))
-                self.queue_update()
+        with self._dispatch_lock:
+            self._funcs.pop(content_id, None)
+        service_name = self.queues.remove(content_id)
+        if service_name is not None:
+            self.feed.publish("queue", service_name=service_name)
+            self._dispatch(service_name)
+
+    def content_queue_pos(self, content):
+        """
+        Return the queue_pos of a Content entry.
+        Only terminal states (-1: Ready, -2: Error) are persisted, positions
+        of pending entries come from the in-memory Queue.
+        """
+        if content.queue_pos < 0:
+            return content.queue_pos
+        queue_pos = self.queue_get_pos(content.content_id)
+        if queue_pos < 0:
+            return content.queue_pos
+        return queue_pos
 
     # =========================================================================
 
-    def serve(self):
-        """ Wraps Flask routes and starts its APP """
-        def get_content_list(uids):
-            """
-            Get and Preprocess data from the DB to be used in the Dashboard
-            """
-            content_list = []
-            for _uid in uids:
-                uid = self.query_one_uid(_uid)
-                if uid and uid.contents:
-                    for c in uid.contents:
-                        if c.queue_pos == -1:
-                            position = status = "Ready"
-                            btn_type = "success"
-                        elif c.queue_pos == -2:
-                            position = status = "Error"
-                            btn_type = "danger"
-                        elif c.queue_pos == 0:
-                            position = status = "Processing"
-                            btn_type = "info"
-                        else:
-                            position = c.queue_pos
-                            status = "Pending"
-                            btn_type = "warning"
-                        
-                        btn_disabled = "disabled" if c.uid != uid else ""
-                        content = "" if c.uid != uid else c.content
-                        
-                        expiration = c.expiration.strftime(
-                            "%m/%d/%Y, %H:%M:%S") if c.expiration else status
-                        if not c.expiration:
-                            btn_disabled = "disabled"
-                        elif c.expiration <= datetime.now():
-                            position = status = "Expired"
-                            btn_type = "danger"
-                            btn_disabled = "disabled"
-                            content = ""
-                            expiration = c.expiration.strftime(
-                                "%m/%d/%Y, %H:%M:%S")
-                        
-                        d = {
-                            "uid": c.uid,
-                            "service": c.service_name,
-                            "rpc_method": c.rpc_method,
-                            "message": c.message,
-                            "content_id": c.content_id,
-                            "queue_pos": position,
-                            "button_class": "btn btn-block btn-{} btn-sm "
-                                            "{}".format(btn_type,
-                                                        btn_disabled),
-                            "status": status,
-                            "content_type": c.content_type,
-                            "content": content
-                            if content is not None else status,
-                            "expiration": expiration,
-                            "date": c.creation.strftime("%m/%d/%Y, %H:%M:%S")
-                        }
-                        content_list.append(d)
-            return content_list
-        
-        def check_uid(uid):
-            if self.query_one_uid(uid):
-                return True
-            return False
-        
-        # ====================== FLASK Routes =================================
-        @app.route("/", methods=["GET", "POST"])
-        def root():
-            if "logged" in session and session["logged"]:
-                return redirect("/dashboard")
+    def serve(self, engine=None, workers=1, threads=None, **options):
+        """
+        Starts the APP with one of these engines (installed separately).
+        Every open Dashboard holds a thread of the engine for its event
+        stream and every /queue_get_pos long-poll one while it waits.
+        Unless max_event_streams / max_long_polls were set they are limited
+        to half / a quarter of the threads (waitress and gunicorn default
+        to 4), the others are kept for the APIs, and past that limit
+        long-polls answer right away.
+        - None: Flask's development server (a thread per request, no limit)
+        - "waitress": multi-threaded WSGI server (threads)
+        - "gunicorn": pre-fork WSGI server (workers processes with threads
+          each), every worker has its own copy of this ContentServer, away
+          from the process calling add()/update(), so it needs a shared
+          queue_store and must be called from the main thread. It can
+          also be run outside, e.g. "gunicorn wsgi:app" with a wsgi.py of
+          app = ContentServer(queue_store=..., ...).app (see create_app())
+        - "uvicorn": ASGI server, the APP is wrapped with asgiref, which
+          runs all its requests in one thread (no event streams nor
+          long-polls)
+        options are passed to the engine.
+        """
+        if engine == "gunicorn":
+            if not self.queues.shared:
+                raise ValueError("gunicorn needs a shared queue_store")
+            if current_thread() is not main_thread():
+                raise ValueError("gunicorn must be run from the main thread")
+
+        threads = threads or options.pop("threads", None)
+        if engine:
+            # Under uvicorn no request can hold the only thread
+            engine_threads = 1 if engine == "uvicorn" else threads or 4
+            if self.max_event_streams is None:
+                self.max_event_streams = engine_threads // 2
+            if self.max_long_polls is None:
+                self.max_long_polls = engine_threads // 4
+
+        self.start_sweeper()
+        app = self.app
+
+        if not engine:
+            # Running Flask App...
+            app.run(debug=False,
+                    host=self.host,
+                    port=self.port,
+                    use_reloader=False,
+                    threaded=True,
+                    passthrough_errors=True)
+        elif engine == "waitress":
+            import waitress
+            if threads:
+                options["threads"] = threads
+            waitress.serve(app, host=self.host, port=self.port, **options)
+        elif engine == "gunicorn":
+            _run_gunicorn(app,
+                          "{}:{}".format(self.host, self.port),
+                          workers,
+                          threads,
+                          options)
+        elif engine == "uvicorn":
+            import uvicorn
+            from asgiref.wsgi import WsgiToAsgi
+            uvicorn.run(WsgiToAsgi(app),
+                        host=self.host,
+                        port=self.port,
+                        **options)
+        else:
+            raise ValueError("Unknown engine: {}".format(engine))
+
+
+# ============================ Flask APP ======================================
+blueprint = Blueprint("content_server", __name__)
+
+
+def create_app(content_server=None, config=None, db_profile=None):
+    """
+    Return a new Flask APP with its own DB engine, configured with the
+    defaults updated by config.
+    db_profile="performance" sets WAL journal, relaxed fsync, busy timeout,
+    larger caches and a thread-safe pool on SQLite DBs (see
+    sqlite_performance_pragmas), other DBs are left as configured.
+    With a content_server, the APP serves it and can be deployed behind any
+    WSGI server. Every ContentServer creates its own APP (ContentServer.app),
+    e.g. in a wsgi.py: app = ContentServer(...).app
+    """
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI="sqlite:///{}/{}/content.db".format(
+            os.getcwd(),
+            db_file_folder),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SECRET_KEY=b"_5#y2L'F4Q8z\n\xec]/")
+    if config:
+        app.config.update(config)
+
+    if db_profile not in (None, "performance"):
+        raise ValueError("Unknown db_profile: {}".format(db_profile))
+    sqlite = app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite")
+    if db_profile and sqlite:
+        options = dict(sqlite_performance_engine_options)
+        options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    db.init_app(app)
+
+    if db_profile and sqlite:
+        with app.app_context():
+            event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.logger.setLevel(logging.ERROR)
+
+    if content_server is not None:
+        app.extensions["content_server"] = content_server
+        app.register_blueprint(blueprint)
+    return app
+
+
+def sqlite_path(db_uri):
+    """ Return the file of a SQLite DB URI, None for other DBs """
+    url = make_url(db_uri)
+    if url.get_backend_name() != "sqlite" or \
+            url.database in (None, "", ":memory:"):
+        return None
+    return os.path.abspath(url.database)
+
+
+def blob_folder(db_uri):
+    """
+    Return the BlobStore folder of a SQLite DB, "blobs" next to the default
+    content.db and "<name>_blobs" for other files, so every DB has its own
+    (sweep_blobs() only knows the references of its DB).
+    Return None for other DBs, their large payloads need a blob_store.
+    """
+    db_path = sqlite_path(db_uri)
+    if db_path is None:
+        return None
+    folder, name = os.path.split(db_path)
+    if name == "content.db":
+        return os.path.join(folder, "blobs")
+    return os.path.join(folder, "{}_blobs".format(os.path.splitext(name)[0]))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_performance_pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(pragma, value))
+    cursor.close()
+
+
+def current_server():
+    """ Return the ContentServer of the current Flask APP """
+    return current_app.extensions["content_server"]
+
+
+def _run_gunicorn(wsgi_app, bind, workers, threads, options):
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(server, worker):
+        # Do not share the DB connections of the master process
+        with wsgi_app.app_context():
+            db.engine.dispose()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            config = {"bind": bind,
+                      "workers": workers,
+                      "worker_class": "gthread",
+                      "threads": threads or 4,
+                      "post_fork": post_fork}
+            config.update(options)
+            for key, value in config.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return wsgi_app
+
+    Application().run()
+
+
+# Columns of the Dashboard tables, in the same order as the templates
+_table_columns = [Content.content_uid,
+                 Content.content_id,
+                 Content.service_name,
+                 Content.rpc_method,
+                 Content.message,
+                 Content.creation,
+                 Content.queue_pos,
+                 Content.expiration,
+                 Content.queue_pos]
+
+
+def _content_query(uids=None):
+    """ Query the Jobs of the uids, uids=None for all (Admin) """
+    query = Job.select()
+    if uids is not None:
+        query = query.filter(Content.content_uid.in_(list(uids)))
+    return query
+
+
+def _queue_status(queue_pos):
+    """ Return the (position, status, button type) of a queue_pos """
+    if queue_pos == -1:
+        return "Ready", "Ready", "success"
+    elif queue_pos == -2:
+        return "Error", "Error", "danger"
+    elif queue_pos == 0:
+        return "Processing", "Processing", "info"
+    return queue_pos, "Pending", "warning"
+
+
+def _content_row(cs, c, now):
+    """
+    Preprocess a Job to be used in the Dashboard, dates (ISO 8601) and
+    buttons are formatted by the template when the row is drawn
+    """
+    position, status, btn_type = _queue_status(cs.content_queue_pos(c))
+
+    content = c.content
+    # Large contents are downloaded from /content/<content_id>
+    content_url = "/content/{}".format(c.content_id) \
+        if c.content_ref else None
+
+    disabled = not c.expiration
+    if c.expiration and c.expiration <= now:
+        position = status = "Expired"
+        btn_type = "danger"
+        disabled = True
+        content = ""
+        content_url = None
+
+    return {
+        "uid": c.content_uid,
+        "service": c.service_name,
+        "rpc_method": c.rpc_method,
+        "message": c.message,
+        "content_id": c.content_id,
+        "queue_pos": position,
+        "btn_type": btn_type,
+        "disabled": disabled,
+        "status": status,
+        "content_type": c.content_type,
+        "content": content if content is not None else status,
+        "content_url": content_url,
+        "expiration": c.expiration.isoformat() if c.expiration else None,
+        "date": c.creation.isoformat()
+    }
+
+
+def _get_content_list(cs, query):
+    """
+    Get and Preprocess data from the DB to be used in the Dashboard
+    """
+    now = datetime.now()
+    return [_content_row(cs, c, now) for c in query]
+
+
+def _get_content_page(cs, uids, args):
+    """
+    Return a page of the Dashboard tables in the DataTables
+    server-side processing format, filtered and sorted in SQL.
+    """
+    query = _content_query(uids)
+    total = query.count()
+
+    # Pending/Processing contents go to the "queue" table,
+    # Ready/Error/Expired ones to the "ready" table.
+    active = and_(Content.queue_pos >= 0,
+                  or_(Content.expiration.is_(None),
+                      Content.expiration > datetime.now()))
+    table = args.get("table", None)
+    if table == "queue":
+        query = query.filter(active)
+    elif table == "ready":
+        query = query.filter(not_(active))
+
+    search = args.get("search[value]", "").strip()
+    if search:
+        pattern = "%{}%".format(search)
+        conditions = [column.like(pattern) for column in (
+            Content.content_uid,
+            Content.service_name,
+            Content.rpc_method,
+            Content.message)]
+        if search.isdigit():
+            conditions.append(Content.content_id == int(search))
+        query = query.filter(or_(*conditions))
+    filtered = query.count()
+
+    column_idx = int(args.get("order[0][column]", 1))
+    column = _table_columns[max(0, min(column_idx,
+                                      len(_table_columns) - 1))]
+    desc = args.get("order[0][dir]", "asc") == "desc"
+    # Pending positions follow the priorities and then the enqueue order,
+    # the turns of fair_share are not in the DB (not orderable then)
+    if table == "queue" and column is Content.queue_pos:
+        if cs.queues.fair_share:
+            order = [Content.content_id]
+        elif desc:
+            order = [Content.priority, Content.queue_seq.desc().nullslast()]
+        else:
+            order = [Content.priority.desc(), Content.queue_seq.nullsfirst()]
+    else:
+        order = [column.desc() if desc else column]
+
+    start = max(0, int(args.get("start", 0)))
+    length = int(args.get("length", 10))
+    if length < 0 or length > api_max_page_length:
+        length = api_max_page_length
+    query = query.order_by(*order, Content.content_id)
+    return {
+        "draw": int(args.get("draw", 0)),
+        "recordsTotal": total,
+        "recordsFiltered": filtered,
+        "data": _get_content_list(cs, query.offset(start).limit(length))
+    }
+
+
+def _render_dashboard(cs, user, admin, uids):
+    query = _content_query(uids)
+    last_content = _get_content_list(
+        cs,
+        query.order_by(Content.content_id.desc()).limit(1))
+    return render_template("dashboard.html",
+                           user=user,
+                           admin=admin,
+                           position_orderable=not cs.queues.fair_share,
+                           content_count=query.count(),
+                           last_content=last_content[0]
+                           if last_content else None)
+
+
+def _event_frame(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+def _event_stream(cs, subscription, uids, max_positions=100):
+    """
+    Server-Sent Events with the changes of the contents of the uids
+    (None for all) driven by a subscription of cs.feed:
+    - "row": a changed row of the Dashboard tables (see _content_row())
+    - "position": the new position/status of a pending row
+    - "reload": rows were added, finished or removed (or too many moved),
+      the tables reload their current page
+    """
+    try:
+        # Pending contents of the uids and their last position
+        query = db.session.query(Content.content_id,
+                                 Content.service_name).filter(
+            Content.queue_pos >= 0)
+        if uids is not None:
+            query = query.filter(Content.content_uid.in_(list(uids)))
+        services = {row.content_id: row.service_name for row in query}
+        db.session.remove()
+        positions = {content_id: cs.queue_get_pos(content_id)
+                     for content_id in services}
+
+        yield "retry: 3000\n\n"
+        deadline = time.time() + event_stream_timeout
+        while time.time() < deadline:
+            events = subscription.get(event_stream_heartbeat)
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+
+            reload = subscription.overflow
+            subscription.overflow = False
+            changed = set()
+            moved = set()
+            for kind, content_ids, uid, service_name in events:
+                if kind == "add":
+                    if uids is None or uid in uids:
+                        for content_id in content_ids:
+                            services[content_id] = service_name
+                        reload = True
+                    moved.add(service_name)
+                elif kind == "update":
+                    changed.update(c for c in content_ids if c in services)
+                elif kind == "remove":
+                    for content_id in content_ids:
+                        if services.pop(content_id, None) is not None:
+                            positions.pop(content_id, None)
+                            reload = True
+                elif kind == "queue":
+                    moved.add(service_name)
+
+            if changed:
+                now = datetime.now()
+                for c in Job.select(Content.content_id.in_(list(changed))):
+                    row = _content_row(cs, c, now)
+                    if c.queue_pos < 0:
+                        services.pop(c.content_id, None)
+                        positions.pop(c.content_id, None)
+                        reload = True
+                    yield _event_frame("row", row)
+                db.session.remove()
+
+            # Past max_positions moved rows the tables are reloaded, the
+            # positions left are forgotten (computed on the next move)
+            deltas = []
+            for content_id, service_name in services.items():
+                if service_name not in moved:
+                    continue
+                if deltas is None:
+                    positions.pop(content_id, None)
+                    continue
+                queue_pos = cs.queue_get_pos(content_id)
+                if queue_pos >= 0 and queue_pos != positions.get(content_id):
+                    positions[content_id] = queue_pos
+                    if len(deltas) == max_positions:
+                        deltas = None
+                        continue
+                    position, status, btn_type = _queue_status(queue_pos)
+                    deltas.append({"content_id": content_id,
+                                   "queue_pos": position,
+                                   "status": status,
+                                   "btn_type": btn_type})
+            if deltas is None:
+                reload = True
             else:
-                return render_template("login.html")
-
-        @app.route("/dashboard", methods=["GET", "POST"])
-        def dashboard():
-            uid = request.args.get("uid", None)
-            if request.method == "POST":
-                uid = request.form.get("uid")
-            elif "logged" in session and session["logged"]:
-                uid = session["uids"][0]
-            
-            if "uids" not in session:
-                session["uids"] = []
-
-            if uid not in session["uids"]:
-                session["uids"].append(uid)
-            session["logged"] = True
-            session.modified = True
-            
-            admin = False
-            if uid == self.admin_pwd:
-                admin = True
-                content_list = []
-                for uid_entry in self.query_all_uid():
-                    content_list.extend(get_content_list([uid_entry.uid]))
-                return render_template("dashboard.html",
-                                       user="Admin",
-                                       admin=admin,
-                                       content_list=content_list)
-            elif check_uid(uid):
-                return render_template("dashboard.html",
-                                       user=session["uids"][0],
-                                       admin=admin,
-                                       content_list=get_content_list(
-                                           session["uids"]))
-            session["uids"] = []
-            session["logged"] = False
-            return redirect("/")
-        
-        @app.route("/add_uid", methods=["POST"])
-        def add_uid():
-            if request.method == "POST":
-                if "logged" in session and session["logged"]:
-                    uid = request.form.get("uid")
-                    if check_uid(uid):
-                        if uid not in session["uids"]:
-                            session["uids"].append(uid)
-                            session.modified = True
-                    return redirect("/dashboard")
-                else:
-                    return render_template("login.html")
-        
-        @app.route("/logout")
-        def logout():
-            session["uids"] = []
-            session["logged"] = False
-            return redirect("/")
-    
-        # POST API - Add new entry in the DB
-        @app.route("/post_add", methods=["POST"])
-        def post_add():
-            try:
-                if request.method == "POST":
-                    user_pwd = request.form.get("user_pwd", None)
-                    if user_pwd == self.admin_pwd:
-                        uid = request.form.get("uid", None)
-                        service_name = request.form.get("service_name", None)
-                        rpc_method = request.form.get("rpc_method", None)
-                        content_type = request.form.get("content_type", None)
-                        uid, content_id = self.add(uid=uid,
-                                                   service_name=service_name,
-                                                   rpc_method=rpc_method,
-                                                   content_type=content_type)
-                        return "{}&{}".format(uid,
-                                                  content_id)
-                    else:
-                        return "Denied"
-            except Exception as e:
-                return str(e)
+                for delta in deltas:
+                    yield _event_frame("position", delta)
 
-        # POST API - Update an entry in the DB
-        @app.route("/post_update", methods=["POST"])
-        def post_update():
-            try:
-                if request.method == "POST":
-                    user_pwd = request.form.get("user_pwd", None)
-                    if user_pwd == self.admin_pwd:
-                        content_id = request.form.get("content_id", None)
-                        queue_pos = request.form.get("queue_pos", None)
-                        expiration = request.form.get("expiration", None)
-                        content = request.form.get("content", None)
-                        self.update(content_id=int(content_id),
-                                    queue_pos=int(queue_pos),
-                                    expiration=expiration,
-                                    content=content)
-                        return content_id
-                    else:
-                        return "Denied"
-            except Exception as e:
-                return str(e)
+            if reload:
+                yield _event_frame("reload", {})
+    finally:
+        subscription.close()
 
-        # POST API - Remove an entry from the DB
-        @app.route("/post_remove", methods=["GET", "POST"])
-        def post_remove():
-            try:
-                if request.method == "GET":
-                    if session["uids"][0] == self.admin_pwd:
-                        uid = request.args.get("uid", None)
-                        content_id = request.args.get("content_id", None)
-                        self.remove(uid=uid,
-                                    content_id=int(content_id))
-                    return redirect("/")
-                elif request.method == "POST":
-                    user_pwd = request.form.get("user_pwd", None)
-                    if user_pwd == self.admin_pwd:
-                        uid = request.form.get("uid", None)
-                        content_id = request.form.get("content_id", None)
-                        self.remove(uid=uid,
-                                    content_id=int(content_id))
-                        return uid
-                    else:
-                        return "Denied"
-            except Exception as e:
-                return str(e)
 
-        # POST API - Return the positing of an entry in the Queue
-        @app.route("/queue_get_pos", methods=["POST"])
-        def queue_get_pos():
-            try:
-                if request.method == "POST":
-                    content_id = request.form.get("content_id", None)
-                    return str(self.queue_get_pos(int(content_id)))
-            except Exception as e:
-                return str(e)
+def _status_digest(cs, uid, content_ids):
+    """
+    Return the digest of the state of a /status request from the
+    StatusIndex, None if the UIDs of some content_ids are unknown
+    """
+    if uid:
+        uids = {uid}
+    else:
+        uids = {cs.status.owner(content_id) for content_id in content_ids}
+        if None in uids:
+            return None
+    positions = dict()
+    for owner in uids:
+        pending = cs.status.pending(owner)
+        if not uid:
+            pending = set(pending).intersection(content_ids)
+        left = []
+        for content_id in pending:
+            queue_pos = cs.queue_get_pos(content_id)
+            if queue_pos < 0:
+                left.append(content_id)
+            else:
+                positions[content_id] = queue_pos
+        cs.status.done(owner, left)
+    return cs.status.digest(uids, positions)
+
+
+def _get_status(cs, uid, content_ids):
+    """ Return the statuses of the contents of uid (or content_ids) """
+    query = db.session.query(Content.content_id,
+                             Content.content_uid,
+                             Content.service_name,
+                             Content.rpc_method,
+                             Content.queue_pos,
+                             Content.expiration)
+    if uid:
+        query = query.filter(Content.content_uid == uid)
+    else:
+        query = query.filter(Content.content_id.in_(content_ids))
+
+    now = datetime.now()
+    expiry = None
+    owners = dict()
+    statuses = []
+    for c in query.order_by(Content.content_id):
+        ids, pending = owners.setdefault(c.content_uid, ([], []))
+        ids.append(c.content_id)
+        if c.queue_pos >= 0:
+            pending.append(c.content_id)
+        queue_pos = cs.content_queue_pos(c)
+        status = _queue_status(queue_pos)[1]
+        if c.expiration:
+            if c.expiration <= now:
+                status = "Expired"
+            elif expiry is None or c.expiration < expiry:
+                expiry = c.expiration
+        statuses.append({
+            "content_id": c.content_id,
+            "service_name": c.service_name,
+            "rpc_method": c.rpc_method,
+            "queue_pos": queue_pos,
+            "status": status,
+            "expiration": c.expiration.isoformat() if c.expiration else None
+        })
+    for owner, (ids, pending) in owners.items():
+        cs.status.learn(owner, ids, pending)
+    return statuses, expiry
+
+
+def _check_uid(cs, uid):
+    return cs.uid_exists(uid)
+
+
+@blueprint.route("/", methods=["GET", "POST"])
+def root():
+    if "logged" in session and session["logged"]:
+        return redirect("/dashboard")
+    else:
+        return render_template("login.html")
+
+
+@blueprint.route("/dashboard", methods=["GET", "POST"])
+def dashboard():
+    cs = current_server()
+    uid = request.args.get("uid", None)
+    if request.method == "POST":
+        uid = request.form.get("uid")
+    elif "logged" in session and session["logged"]:
+        uid = session["uids"][0]
+
+    if "uids" not in session:
+        session["uids"] = []
+
+    if uid not in session["uids"]:
+        session["uids"].append(uid)
+    session["logged"] = True
+    session.modified = True
+
+    admin = False
+    if uid == cs.admin_pwd:
+        admin = True
+        return _render_dashboard(cs, "Admin", admin, None)
+    elif _check_uid(cs, uid):
+        return _render_dashboard(cs,
+                                 session["uids"][0],
+                                 admin,
+                                 session["uids"])
+    session["uids"] = []
+    session["logged"] = False
+    return redirect("/")
+
+
+@blueprint.route("/add_uid", methods=["POST"])
+def add_uid():
+    cs = current_server()
+    if request.method == "POST":
+        if "logged" in session and session["logged"]:
+            uid = request.form.get("uid")
+            if _check_uid(cs, uid):
+                if uid not in session["uids"]:
+                    session["uids"].append(uid)
+                    session.modified = True
+            return redirect("/dashboard")
+        else:
+            return render_template("login.html")
+
+
+@blueprint.route("/logout")
+def logout():
+    session["uids"] = []
+    session["logged"] = False
+    return redirect("/")
+
+
+# GET API - Pages of the Dashboard tables (DataTables server-side)
+@blueprint.route("/api/contents", methods=["GET"])
+def api_contents():
+    cs = current_server()
+    try:
+        if "logged" in session and session["logged"] \
+                and session["uids"]:
+            uids = session["uids"]
+            if uids[0] == cs.admin_pwd:
+                uids = None
+            return jsonify(_get_content_page(cs, uids, request.args))
+        else:
+            return jsonify({"error": "Denied"}), 403
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# GET API - Download the content of an entry, large ones are streamed from
+# the BlobStore (Range requests, sendfile by the WSGI server when supported,
+# compressed blobs with their Content-Encoding if accepted).
+# Allowed to the Dashboard session of its UID (or Admin) and with ?uid=
+@blueprint.route("/content/<int:content_id>", methods=["GET"])
+def get_content(content_id):
+    cs = current_server()
+    c = cs.get_job(content_id)
+    if not c:
+        abort(404)
+    uids = session.get("uids", []) if session.get("logged", False) else []
+    if c.content_uid != request.args.get("uid", None) \
+            and c.content_uid not in uids \
+            and cs.admin_pwd not in uids[:1]:
+        abort(403)
+    if c.expiration and c.expiration <= datetime.now():
+        abort(404)
+    mimetype = c.content_type if c.content_type and "/" in c.content_type \
+        else None
+    if c.content_ref:
+        mimetype = mimetype or "application/octet-stream"
+        path, encoding = cs.blobs.locate(c.content_ref)
+        if encoding is None:
+            return send_file(path,
+                             mimetype=mimetype,
+                             conditional=True,
+                             etag=c.content_ref,
+                             max_age=0)
+        # Compressed blobs are sent as they are stored when the client
+        # accepts their encoding, else decompressed on the fly
+        if encoding in request.accept_encodings:
+            response = send_file(path,
+                                 mimetype=mimetype,
+                                 conditional=True,
+                                 etag="{}-{}".format(c.content_ref, encoding),
+                                 max_age=0)
+            response.content_encoding = encoding
+        else:
+            response = send_file(cs.blobs.open(c.content_ref),
+                                 mimetype=mimetype,
+                                 conditional=True,
+                                 etag=c.content_ref,
+                                 max_age=0)
+        response.vary.add("Accept-Encoding")
+        return response
+    if c.content is None:
+        abort(404)
+    return current_app.response_class(c.content,
+                                      mimetype=mimetype or "text/plain")
+
+
+# GET API - Stream (Server-Sent Events) of the changes of the contents of
+# the session, the Dashboard patches its tables with them
+@blueprint.route("/api/events", methods=["GET"])
+def api_events():
+    cs = current_server()
+    if "logged" in session and session["logged"] and session["uids"]:
+        uids = session["uids"]
+        if uids[0] == cs.admin_pwd:
+            uids = None
+        subscription = cs.feed.subscribe(
+            max_subscriptions=cs.max_event_streams)
+        if subscription is None:
+            return jsonify({"error": "Too many event streams"}), 503
+        response = current_app.response_class(
+            stream_with_context(_event_stream(cs, subscription, uids)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache",
+                     "X-Accel-Buffering": "no"})
+        # Also when the stream is closed before it starts
+        response.call_on_close(subscription.close)
+        return response
+    return jsonify({"error": "Denied"}), 403
+
+
+# GET API - Status (position, status, expiration) of many contents at once,
+# of a ?uid= or of the listed ?content_id=&content_id=...
+# The ETag changes with them, If-None-Match polls get a 304 with no DB access.
+# Changes made by other processes do not change it, so it is only valid for
+# cache_ttl seconds (like the caches) and not sent with shared QueueStores.
+@blueprint.route("/status", methods=["GET"])
+def get_status():
+    cs = current_server()
+    try:
+        uid = request.args.get("uid", None)
+        content_ids = [int(c) for c in request.args.getlist("content_id")]
+        if not uid and not content_ids:
+            return jsonify({"error": "uid or content_id required"}), 400
+
+        # ETag: "<digest>.<deadline>", valid until the first expiration
+        # of the contents and at most cache_ttl seconds
+        digest = None
+        if not cs.queues.shared:
+            digest = _status_digest(cs, uid, content_ids)
+        if digest is not None:
+            for etag in request.if_none_match:
+                tag_digest, _, deadline = etag.partition(".")
+                if tag_digest == digest and deadline.isdigit() and \
+                        time.time() < int(deadline):
+                    response = current_app.response_class(status=304)
+                    response.set_etag(etag)
+                    return response
+
+        statuses, expiry = _get_status(cs, uid, content_ids)
+        db.session.remove()
+        response = jsonify({"contents": statuses})
+        response.headers["Cache-Control"] = "no-cache"
+        # Without a digest taken before the query the ETag could be newer
+        # than the statuses, the next poll gets one
+        if digest is not None:
+            deadline = time.time() + cs.content_cache.ttl
+            if expiry:
+                deadline = min(deadline,
+                               time.mktime(expiry.timetuple()) + 1)
+            response.set_etag("{}.{}".format(digest, int(deadline)))
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+# POST API - Add new entry in the DB
+@blueprint.route("/post_add", methods=["POST"])
+def post_add():
+    cs = current_server()
+    try:
+        if request.method == "POST":
+            user_pwd = request.form.get("user_pwd", None)
+            if user_pwd == cs.admin_pwd:
+                uid = request.form.get("uid", None)
+                service_name = request.form.get("service_name", None)
+                rpc_method = request.form.get("rpc_method", None)
+                content_type = request.form.get("content_type", None)
+                request_key = request.form.get("request_key", None)
+                priority = int(request.form.get("priority", 0))
+                uid, content_id = cs.add(uid=uid,
+                                         service_name=service_name,
+                                         rpc_method=rpc_method,
+                                         content_type=content_type,
+                                         request_key=request_key,
+                                         priority=priority)
+                return "{}&{}".format(uid, content_id)
+            else:
+                return "Denied"
+    except Exception as e:
+        return str(e)
+
+
+# POST API - Add a batch of entries in the DB
+@blueprint.route("/post_add_batch", methods=["POST"])
+def post_add_batch():
+    cs = current_server()
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            user_pwd = data.get("user_pwd", None)
+            if user_pwd == cs.admin_pwd:
+                keys = ("uid", "service_name", "rpc_method",
+                        "message", "content_type", "priority")
+                jobs = [{k: job[k] for k in keys if k in job}
+                        for job in data.get("jobs", [])]
+                added = cs.add_many(jobs, uid=data.get("uid", None))
+                return jsonify([{"uid": uid, "content_id": content_id}
+                                for uid, content_id in added])
+            else:
+                return "Denied"
+    except Exception as e:
+        return str(e)
+
+
+# POST API - Update an entry in the DB
+@blueprint.route("/post_update", methods=["POST"])
+def post_update():
+    cs = current_server()
+    try:
+        if request.method == "POST":
+            user_pwd = request.form.get("user_pwd", None)
+            if user_pwd == cs.admin_pwd:
+                content_id = request.form.get("content_id", None)
+                queue_pos = request.form.get("queue_pos", None)
+                expiration = request.form.get("expiration", None)
+                content = request.form.get("content", None)
+                cs.update(content_id=int(content_id),
+                          queue_pos=int(queue_pos),
+                          expiration=expiration,
+                          content=content)
+                return content_id
+            else:
+                return "Denied"
+    except Exception as e:
+        return str(e)
+
+
+# POST API - Remove an entry from the DB
+@blueprint.route("/post_remove", methods=["GET", "POST"])
+def post_remove():
+    cs = current_server()
+    try:
+        if request.method == "GET":
+            if session["uids"][0] == cs.admin_pwd:
+                uid = request.args.get("uid", None)
+                content_id = request.args.get("content_id", None)
+                cs.remove(uid=uid,
+                          content_id=int(content_id))
+            return redirect("/")
+        elif request.method == "POST":
+            user_pwd = request.form.get("user_pwd", None)
+            if user_pwd == cs.admin_pwd:
+                uid = request.form.get("uid", None)
+                content_id = request.form.get("content_id", None)
+                cs.remove(uid=uid,
+                          content_id=int(content_id))
+                return uid
+            else:
+                return "Denied"
+    except Exception as e:
+        return str(e)
 
-        # ==============================================================================================================
 
-        # Running Flask App...
-        app.run(debug=False,
-                host=self.host,
-                port=self.port,
-                use_reloader=False,
-                threaded=True,
-                passthrough_errors=True)
+# POST API - Return the positing of an entry in the Queue
+# With a "timeout" (seconds) it long-polls until it is the entry turn
+@blueprint.route("/queue_get_pos", methods=["POST"])
+def queue_get_pos():
+    cs = current_server()
+    try:
+        if request.method == "POST":
+            content_id = request.form.get("content_id", None)
+            timeout = request.form.get("timeout", None)
+            if timeout:
+                timeout = min(float(timeout), long_poll_max_timeout)
+                return str(cs.long_poll_turn(int(content_id), timeout))
+            return str(cs.queue_get_pos(int(content_id)))
+    except Exception as e:
+        return str(e)
@@ -0,0 +1,275 @@
+import os
+import asyncio
+import functools
+from datetime import datetime
+
+from sqlalchemy import select, delete
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from content_server import ContentServer, UID, Content, db, db_file_folder, \
+    blob_folder, sqlite_path
+from content_server.queues import MemoryQueueStore
+from content_server.blobs import BlobStore
+
+
+class AsyncMemoryQueueStore(MemoryQueueStore):
+    """ MemoryQueueStore whose waiters are asyncio Events of a single loop """
+    async def wait(self, content_id, timeout=None):
+        with self._lock:
+            if self._has_turn(content_id):
+                return self.get_pos(content_id)
+            event = self._events.setdefault(content_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._lock:
+            if self._has_turn(content_id):
+                self._events.pop(content_id, None)
+            return self.get_pos(content_id)
+
+
+class AsyncContentServer:
+    """
+    asyncio version of the ContentServer DB and Queue methods.
+    Uses an async DB driver (aiosqlite by default, pip install aiosqlite)
+    and must be used from a single event loop. Job funcs can be coroutine
+    functions, plain funcs run in the loop default executor.
+    """
+    def __init__(self, db_uri=None, queues=None, workers=None,
+                 fair_share=False, uid_weights=None, blob_store=None,
+                 log=None):
+        if not db_uri:
+            db_uri = "sqlite+aiosqlite:///{}/{}/content.db".format(
+                os.getcwd(),
+                db_file_folder)
+        self.engine = create_async_engine(db_uri)
+        self.session = sessionmaker(self.engine,
+                                    class_=AsyncSession,
+                                    expire_on_commit=False)
+
+        self.workers = dict(workers or {})
+        self.queues = AsyncMemoryQueueStore(queues, slots=self.workers)
+        self.queues.fair_share = fair_share
+        self.queues.weights = dict(uid_weights or {})
+        self.blobs = blob_store or BlobStore(blob_folder(db_uri))
+
+        # Funcs waiting for their turn and the running ones
+        self._funcs = dict()
+        self._tasks = set()
+
+        self.log = log
+
+    # ========================= DB Methods ====================================
+    async def create(self, drop=False):
+        db_path = sqlite_path(self.engine.url)
+        if db_path:
+            folder = os.path.dirname(db_path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+        async with self.engine.begin() as conn:
+            if drop:
+                await conn.run_sync(db.metadata.drop_all)
+            await conn.run_sync(db.metadata.create_all)
+            await conn.run_sync(ContentServer.migrate)
+        await self.restore_queues()
+
+    async def restore_queues(self):
+        """ Same as ContentServer.restore_queues() """
+        async with self.session() as s:
+            rows = await s.execute(
+                select(Content.service_name,
+                       Content.content_id,
+                       Content.queue_seq,
+                       Content.priority,
+                       Content.content_uid).where(
+                    Content.queue_pos >= 0,
+                    Content.source_id.is_(None)).order_by(
+                    Content.service_name,
+                    Content.queue_seq.nullsfirst(),
+                    Content.content_id))
+        self.queues.extend([(row.service_name, row.content_id, row.queue_seq,
+                             row.priority, row.content_uid) for row in rows])
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def query_all_uid(self):
+        async with self.session() as s:
+            return (await s.execute(select(UID))).scalars().all()
+
+    async def query_one_uid(self, uid):
+        async with self.session() as s:
+            return await s.get(UID, uid)
+
+    async def query_all_content(self, uid):
+        async with self.session() as s:
+            return (await s.execute(
+                select(Content).where(Content.content_uid == uid)
+            )).scalars().all()
+
+    async def query_one_content(self, content_id):
+        async with self.session() as s:
+            return await s.get(Content, content_id)
+
+    async def add(self, uid=None, service_name="test_service",
+                  rpc_method=None, message=None, content_type=None,
+                  func=None, args=None, priority=0):
+        async with self.session() as s:
+            new_uid = not uid
+            if new_uid:
+                uid = ContentServer._generate_uid()
+
+            if self.log:
+                self.log.info("Adding content: {} {}".format(uid, rpc_method))
+
+            if new_uid or not await s.get(UID, uid):
+                s.add(UID(uid=uid))
+
+            content = Content(content_uid=uid,
+                              service_name=service_name,
+                              rpc_method=rpc_method,
+                              message=message,
+                              queue_pos=self.queues.size(service_name),
+                              queue_seq=self.queues.reserve(service_name),
+                              priority=priority,
+                              content_type=content_type)
+            s.add(content)
+            await s.commit()
+
+        self.queues.append(service_name, content.content_id, content.queue_seq,
+                           priority, uid)
+
+        if func:
+            self._funcs[content.content_id] = (func, uid, rpc_method, args)
+            self._dispatch(service_name)
+
+        return uid, content.content_id
+
+    async def update(self, content_id, queue_pos=0,
+                     message=None, expiration=None, content=None):
+        if self.log:
+            self.log.info("Updating content: {} Queue: {}".format(content_id,
+                                                                  queue_pos))
+
+        if content:
+            # Large contents are written to the BlobStore off the loop
+            content = await asyncio.get_event_loop().run_in_executor(
+                None, self.blobs.store, content)
+
+        async with self.session() as s:
+            c = await s.get(Content, content_id)
+            if not c:
+                return
+            c.queue_pos = queue_pos
+            # Error
+            if queue_pos == -2:
+                c.expiration = None
+            elif expiration:
+                c.expiration = datetime.now() + \
+                    ContentServer._get_delta_str(expiration)
+
+            if message:
+                c.message = message
+            if content:
+                c.content = content["content"]
+                c.content_ref = content["content_ref"]
+
+            await s.commit()
+
+        if queue_pos == -1 or queue_pos == -2:
+            self.queue_rem_pos(content_id)
+
+    async def read_content(self, content):
+        """ Same as ContentServer.read_content() """
+        if content.content_ref:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self.blobs.read, content.content_ref)
+        return content.content
+
+    async def remove(self, uid=None, content_id=None):
+        if self.log:
+            self.log.info("Removing content: {}".format(content_id))
+
+        async with self.session() as s:
+            # Remove the UID with all its contents
+            if uid:
+                content_ids = (await s.execute(
+                    select(Content.content_id).where(
+                        Content.content_uid == uid))).scalars().all()
+                await s.execute(
+                    delete(Content).where(Content.content_uid == uid))
+                await s.execute(delete(UID).where(UID.uid == uid))
+            # Else remove just the target content
+            elif content_id:
+                content_ids = [content_id]
+                await s.execute(
+                    delete(Content).where(Content.content_id == content_id))
+            else:
+                return
+            await s.commit()
+
+        for content_id in content_ids:
+            self.queue_rem_pos(content_id)
+
+    # ============================ Queue Methods ==============================
+    def queue_get_pos(self, content_id):
+        """ Return the position of item in the Queue of a Service """
+        return self.queues.get_pos(content_id)
+
+    async def wait_for_turn(self, content_id, timeout=None):
+        """ Same as ContentServer.wait_for_turn() without blocking the loop """
+        return await self.queues.wait(content_id, timeout)
+
+    def queue_rem_pos(self, content_id):
+        """ Remove an item from the Queue """
+        self._funcs.pop(content_id, None)
+        service_name = self.queues.remove(content_id)
+        if service_name is not None:
+            self._dispatch(service_name)
+
+    def content_queue_pos(self, content):
+        """ Return the queue_pos of a Content entry """
+        if content.queue_pos < 0:
+            return content.queue_pos
+        queue_pos = self.queue_get_pos(content.content_id)
+        if queue_pos < 0:
+            return content.queue_pos
+        return queue_pos
+
+    # =========================================================================
+
+    def _dispatch(self, service_name):
+        """ Start the funcs of the jobs that have their turn """
+        if not self._funcs:
+            return
+        loop = asyncio.get_event_loop()
+        for content_id in self.queues.head(service_name):
+            if content_id not in self._funcs:
+                continue
+            func, uid, rpc_method, args = self._funcs.pop(content_id)
+            if asyncio.iscoroutinefunction(func):
+                task = loop.create_task(
+                    func(uid, content_id, rpc_method, **(args or {})))
+            else:
+                task = loop.run_in_executor(
+                    None,
+                    lambda f=func, a=(uid, content_id, rpc_method),
+                    k=args or {}: f(*a, **k))
+            self._tasks.add(task)
+            task.add_done_callback(
+                functools.partial(self._func_done, content_id))
+
+    def _func_done(self, content_id, task):
+        """ Same as ContentServer._func_done() """
+        self._tasks.discard(task)
+        if task.cancelled() or not task.exception():
+            return
+        if self.log:
+            self.log.error("Job func failed: {}".format(task.exception()))
+        if self.queues.get_pos(content_id) >= 0:
+            task = asyncio.ensure_future(
+                self.update(content_id, queue_pos=-2))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,151 @@
+import os
+import gzip
+import time
+import hashlib
+import importlib.util
+import tempfile
+
+# File suffix of the blobs of each compression
+_suffixes = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class BlobStore:
+    """
+    Content-addressed file store for the large results of the jobs.
+    Payloads up to inline_limit chars stay in the Content row, larger ones
+    (and bytes) are written once to folder/<sha256[:2]>/<sha256> and the row
+    keeps only the sha256 (Content.content_ref), so identical payloads are
+    stored once.
+    Blobs are never deleted while referenced, sweep() purges the ones left
+    without references for more than grace seconds.
+    compression="gzip" (zlib), "zstd" (pip install zstandard) or "auto"
+    (zstd if installed) compresses blobs of at least compress_min_size bytes
+    when it makes them smaller. Blobs written with other settings are still
+    read, keys do not depend on the compression.
+    Without a folder every payload must stay inline, put() raises ValueError.
+    """
+    def __init__(self, folder, inline_limit=4096, grace=600,
+                 compression=None, compress_min_size=1024, level=None):
+        if compression == "auto":
+            compression = "zstd" if importlib.util.find_spec("zstandard") \
+                else "gzip"
+        if compression not in _suffixes:
+            raise ValueError("Unknown compression: {}".format(compression))
+        self.folder = folder
+        self.inline_limit = inline_limit
+        self.grace = grace
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self.level = level
+
+    def store(self, content):
+        """ Return the Content columns ({content, content_ref}) of content """
+        if isinstance(content, str) and len(content) <= self.inline_limit:
+            return {"content": content, "content_ref": None}
+        return {"content": None, "content_ref": self.put(content)}
+
+    def put(self, data):
+        """ Write data (str as utf-8) and return its key """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.folder is None:
+            raise ValueError("No BlobStore folder to store a {} bytes "
+                             "payload, pass a blob_store".format(len(data)))
+        key = hashlib.sha256(data).hexdigest()
+        try:
+            # Same payload already stored, refresh it for the grace period
+            os.utime(self.locate(key)[0], None)
+            return key
+        except FileNotFoundError:
+            pass
+
+        encoding = None
+        if self.compression and len(data) >= self.compress_min_size:
+            compressed = self._compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                encoding = self.compression
+
+        path = self.path(key) + _suffixes[encoding]
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        return key
+
+    def path(self, key):
+        """ Path of an uncompressed blob, see locate() """
+        return os.path.join(self.folder, key[:2], key)
+
+    def locate(self, key):
+        """ Return the (path, compression) of a stored blob """
+        if self.folder is None:
+            raise FileNotFoundError(key)
+        path = self.path(key)
+        for encoding, suffix in _suffixes.items():
+            if os.path.exists(path + suffix):
+                return path + suffix, encoding
+        raise FileNotFoundError(path)
+
+    def exists(self, key):
+        try:
+            self.locate(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open(self, key):
+        """ Return a file object reading the uncompressed blob """
+        path, encoding = self.locate(key)
+        if encoding == "gzip":
+            return gzip.open(path, "rb")
+        if encoding == "zstd":
+            import zstandard
+            return zstandard.open(path, "rb")
+        return open(path, "rb")
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def delete(self, key):
+        path = self.path(key)
+        for suffix in _suffixes.values():
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def keys(self, older_than=None):
+        """ Iterate the stored keys, only the ones older_than seconds """
+        if self.folder is None or not os.path.isdir(self.folder):
+            return
+        limit = time.time() - older_than if older_than else None
+        for prefix in os.listdir(self.folder):
+            folder = os.path.join(self.folder, prefix)
+            if len(prefix) != 2 or not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.startswith("."):
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                if limit and mtime > limit:
+                    continue
+                yield name.split(".")[0]
+
+    def _compress(self, data):
+        if self.compression == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor(
+                level=self.level or 3).compress(data)
+        return gzip.compress(data, self.level or 6)
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+_missing = object()
+
+
+class LRUCache:
+    """
+    Thread-safe read-through cache of at most size entries, each one valid
+    for ttl seconds (size=0 disables it).
+    A value loaded while its key is invalidated is not stored, so a load
+    racing with a write never caches the old value.
+    stats counts the hits and misses.
+    """
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # Last invalidation of the recently invalidated keys, loads started
+        # before _floor (a clear() or a forgotten stamp) are not stored
+        self._clock = 0
+        self._stamps = OrderedDict()
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader):
+        """ Return the value of key, loader() is called on a miss """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            start = self._clock
+        value = loader()
+        with self._lock:
+            if self._stamps.get(key, 0) <= start and self._floor <= start:
+                self._set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._clock += 1
+            self._stamps[key] = self._clock
+            self._stamps.move_to_end(key)
+            while len(self._stamps) > max(self.size, 1024):
+                self._floor = self._stamps.popitem(last=False)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._clock += 1
+            self._floor = self._clock
+
+    def _set(self, key, value):
+        if not self.size:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
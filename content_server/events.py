@@ -0,0 +1,78 @@
+from collections import deque
+from threading import Lock, Event
+
+
+class Subscription:
+    """
+    Changes published to a ChangeFeed since the last get(), at most
+    max_events of them (older ones are dropped and overflow is set, the
+    subscriber should reload its whole state).
+    """
+    def __init__(self, feed, max_events=1000):
+        self.feed = feed
+        self.overflow = False
+        self._events = deque(maxlen=max_events)
+        self._ready = Event()
+
+    def put(self, event):
+        if len(self._events) == self._events.maxlen:
+            self.overflow = True
+        self._events.append(event)
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """ Return the pending events, [] if timeout expires first """
+        self._ready.wait(timeout)
+        with self.feed._lock:
+            self._ready.clear()
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed:
+    """
+    Fan-out of the changes of the contents (see ContentServer.feed) to
+    subscribers, e.g. the Dashboard event streams. Events are tuples of
+    (kind, content_ids, uid, service_name):
+    - ("add", [content_id, ...], uid, service_name)
+    - ("update", [content_id, ...], None, None)
+    - ("remove", [content_id, ...], None, None)
+    - ("queue", [], None, service_name), the positions of a Queue moved
+    listeners are called with each event by the publishing thread,
+    publishing without listeners nor subscribers is a no-op.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._subscriptions = set()
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, max_events=1000, max_subscriptions=None):
+        """ Return a new Subscription, None if max_subscriptions are open """
+        subscription = Subscription(self, max_events)
+        with self._lock:
+            if max_subscriptions is not None and \
+                    len(self._subscriptions) >= max_subscriptions:
+                return None
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, kind, content_ids=(), uid=None, service_name=None):
+        event = (kind, list(content_ids), uid, service_name)
+        for listener in self.listeners:
+            listener(*event)
+        if not self._subscriptions:
+            return
+        with self._lock:
+            for subscription in self._subscriptions:
+                subscription.put(event)
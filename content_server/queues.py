@@ -0,0 +1,708 @@
+import time
+from bisect import bisect_left, insort
+from threading import RLock, Event
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, Index, \
+    create_engine, select, insert, update, delete, func, inspect, text, \
+    and_, or_
+from sqlalchemy.exc import IntegrityError
+
+
+class ServiceQueue:
+    """
+    Queue of a single Service.
+
+    Entries are ordered by (-priority, round, seq): higher priorities first,
+    then by fair-share round and by their sequence (reserved before they are
+    enqueued, so it can be persisted with the entry). Without priorities and
+    fair share it is a FIFO Queue.
+
+    Fair share (append() with a weight) gives every UID weight entries per
+    round, a deficit round robin with a quantum of one job: a new entry
+    takes the current round (the one of the head of the Queue) unless its
+    UID already used it, so a UID with many pending entries cannot hold back
+    the others.
+
+    With slots, the entries that have their turn (position < slots) are
+    pinned: they keep their positions and new entries are always enqueued
+    after them, whatever their priority or round.
+
+    Keys are kept in a sorted list split in blocks, plus a Fenwick tree over
+    the block sizes, so the position of an item is O(log n) and enqueue and
+    removal are O(log n + block size).
+    """
+    _load = 512
+
+    def __init__(self, content_ids=None, slots=None):
+        self.slots = slots
+        self._next_seq = 0
+        # Keys in order, split in blocks:
+        # - (0, pin, content_id) for the pinned entries, in pinning order
+        # - (1, -priority, round, seq, content_id) for the others
+        self._blocks = []
+        self._maxes = []
+        self._tree = [0]
+        self._keys = dict()
+        self._pinned = 0
+        self._next_pin = 0
+        # Fair share: current round and {uid: (round, entries in round)}
+        self._round = 0
+        self._uids = dict()
+        for content_id in content_ids or []:
+            self.append(content_id)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, content_id):
+        return content_id in self._keys
+
+    def __iter__(self):
+        for block in list(self._blocks):
+            for key in list(block):
+                yield key[-1]
+
+    def __repr__(self):
+        return "{}".format(list(self))
+
+    def reserve(self):
+        """ Return a new sequence for an item that is about to be enqueued """
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def append(self, content_id, seq=None, priority=0, uid=None,
+               weight=None):
+        """
+        Enqueue an item (at a reserved sequence) and return its position.
+        With a weight the item takes a fair-share round of its uid.
+        """
+        if content_id in self._keys:
+            return self.position(content_id)
+        if seq is None:
+            seq = self.reserve()
+        else:
+            self._next_seq = max(self._next_seq, seq + 1)
+        key = (1,
+               -(priority or 0),
+               self._next_round(uid, weight) if weight else 0,
+               seq,
+               content_id)
+        self._keys[content_id] = key
+        self._insert(key)
+        self._pin()
+        return self.position(content_id)
+
+    def position(self, content_id):
+        """ Return the position of an item, -1 if it is not in the Queue """
+        key = self._keys.get(content_id, None)
+        if key is None:
+            return -1
+        i = bisect_left(self._maxes, key)
+        return self._tree_sum(i) + bisect_left(self._blocks[i], key)
+
+    def remove(self, content_id):
+        """ Remove an item, return False if it was not in the Queue """
+        key = self._keys.pop(content_id, None)
+        if key is None:
+            return False
+        if key[0] == 0:
+            self._pinned -= 1
+        self._delete(key)
+        self._pin()
+        return True
+
+    def _pin(self):
+        """ Pin the entries that have their turn """
+        if not self.slots:
+            return
+        while self._pinned < min(self.slots, len(self._keys)):
+            # The first entry that is not pinned
+            index = self._pinned
+            for block in self._blocks:
+                if index < len(block):
+                    break
+                index -= len(block)
+            key = block[index]
+            # Entries reaching the head start the current round
+            self._round = max(self._round, key[2])
+            self._delete(key)
+            pinned = (0, self._next_pin, key[-1])
+            self._next_pin += 1
+            self._keys[key[-1]] = pinned
+            self._insert(pinned)
+            self._pinned += 1
+
+    def _delete(self, key):
+        i = bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
+            self._tree_add(i + 1, -1)
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+            self._rebuild()
+
+    def head(self, n=1):
+        """ Return the first n items of the Queue """
+        items = []
+        for block in self._blocks:
+            for key in block:
+                if len(items) >= n:
+                    return items
+                items.append(key[-1])
+        return items
+
+    def _next_round(self, uid, weight):
+        head = self._blocks[0][0] if self._blocks else None
+        if head is not None and head[0] == 1:
+            self._round = max(self._round, head[2])
+        elif head is None and self._uids:
+            self._uids.clear()
+        current, count = self._uids.get(uid, (self._round, 0))
+        if current < self._round:
+            current, count = self._round, 0
+        if count >= weight:
+            current, count = current + 1, 0
+        self._uids[uid] = (current, count + 1)
+        if len(self._uids) > 2 * len(self._keys) + 1024:
+            # Forget the UIDs that are back to the current round
+            self._uids = {u: r for u, r in self._uids.items()
+                          if r[0] > self._round}
+        return current
+
+    def _insert(self, key):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._rebuild()
+            return
+        i = min(bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * self._load:
+            self._blocks[i:i + 1] = [block[:self._load],
+                                     block[self._load:]]
+            self._maxes[i:i + 1] = [block[self._load - 1], block[-1]]
+            self._rebuild()
+        else:
+            self._tree_add(i + 1, 1)
+
+    def _rebuild(self):
+        """ Linear time Fenwick construction over the block sizes """
+        size = len(self._blocks)
+        tree = [0] + [len(block) for block in self._blocks]
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, value):
+        size = len(self._tree) - 1
+        while i <= size:
+            self._tree[i] += value
+            i += i & -i
+
+    def _tree_sum(self, i):
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class QueueStore:
+    """
+    Service Queues of a ContentServer.
+
+    Items are content_ids queued per service_name by priority (higher
+    first) and in the order of a sequence reserved before they are enqueued.
+    slots maps a service_name to how many items of its Queue are processed
+    at the same time (default 1): an item whose position is lower than that
+    has its turn.
+    Stores with fair share support (see ServiceQueue) interleave the UIDs
+    of a Service when fair_share is set, weights maps a uid to its share
+    (default 1).
+
+    Stores that are shared by many processes (shared = True) cannot notify
+    local waiters, so wait() polls every poll_interval seconds.
+    """
+    shared = True
+    poll_interval = 0.1
+    fair_share = False
+
+    def __init__(self, slots=None):
+        self.slots = dict(slots or {})
+        self.weights = dict()
+
+    def reserve(self, service_name):
+        """ Return the sequence of the next item of a Service Queue """
+        raise NotImplementedError
+
+    def append(self, service_name, content_id, seq=None, priority=0,
+               uid=None):
+        """ Enqueue an item (at a reserved sequence), return its position """
+        raise NotImplementedError
+
+    def extend(self, items):
+        """
+        Enqueue a list of (service_name, content_id), optionally followed by
+        seq, priority and uid
+        """
+        return [self.append(*item) for item in items]
+
+    def get_pos(self, content_id):
+        """ Return the position of an item, -1 if it is not queued """
+        raise NotImplementedError
+
+    def remove(self, content_id):
+        """ Remove an item, return the Service it was queued in (or None) """
+        raise NotImplementedError
+
+    def service(self, content_id):
+        """ Return the Service whose Queue holds the item (or None) """
+        raise NotImplementedError
+
+    def size(self, service_name):
+        """ Return the number of items in the Queue of a Service """
+        raise NotImplementedError
+
+    def content_ids(self, service_name, n=None):
+        """ Return the first n (or all) items of a Service Queue """
+        raise NotImplementedError
+
+    def services(self):
+        """ Return the names of the Services with a Queue """
+        raise NotImplementedError
+
+    def items(self):
+        return [(service_name, self.content_ids(service_name))
+                for service_name in self.services()]
+
+    def head(self, service_name):
+        """ Return the items of a Service that have their turn """
+        return self.content_ids(service_name,
+                                self.slots.get(service_name, 1))
+
+    def wait(self, content_id, timeout=None):
+        """
+        Block until the item has its turn (or leaves the Queue) and return
+        its position, -1 if it left the Queue.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._has_turn(content_id):
+            delay = self.poll_interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    break
+            time.sleep(delay)
+        return self.get_pos(content_id)
+
+    def _has_turn(self, content_id):
+        service_name = self.service(content_id)
+        if service_name is None:
+            return True
+        return self.get_pos(content_id) < self.slots.get(service_name, 1)
+
+
+class MemoryQueueStore(QueueStore):
+    """
+    In-process Service Queues plus a content_id -> service_name map,
+    so an item is found without scanning every Service.
+    Waiters are notified with an Event when their item has its turn.
+    """
+    shared = False
+
+    def __init__(self, queues=None, slots=None):
+        super().__init__(slots)
+        self._lock = RLock()
+        self._queues = dict()
+        self._services = dict()
+        # content_id -> Event set when the item reaches the head of its Queue
+        self._events = dict()
+        for service_name, content_ids in (queues or {}).items():
+            for content_id in content_ids:
+                self.append(service_name, content_id)
+
+    def __contains__(self, service_name):
+        return service_name in self._queues
+
+    def __getitem__(self, service_name):
+        return self._queues[service_name]
+
+    def __iter__(self):
+        return iter(self._queues)
+
+    def __len__(self):
+        return len(self._queues)
+
+    def __repr__(self):
+        return "{}".format(self._queues)
+
+    def items(self):
+        with self._lock:
+            return list(self._queues.items())
+
+    def services(self):
+        with self._lock:
+            return list(self._queues)
+
+    def content_ids(self, service_name, n=None):
+        with self._lock:
+            queue = self._queues.get(service_name, None)
+            if not queue:
+                return []
+            return queue.head(n) if n is not None else list(queue)
+
+    def size(self, service_name):
+        with self._lock:
+            queue = self._queues.get(service_name, None)
+            return len(queue) if queue else 0
+
+    def service(self, content_id):
+        return self._services.get(content_id, None)
+
+    def reserve(self, service_name):
+        with self._lock:
+            return self._queue(service_name).reserve()
+
+    def append(self, service_name, content_id, seq=None, priority=0,
+               uid=None):
+        with self._lock:
+            current = self._services.get(content_id, None)
+            if current is not None and current != service_name:
+                self._queue(current).remove(content_id)
+            self._services[content_id] = service_name
+            weight = self.weights.get(uid, 1) if self.fair_share else None
+            return self._queue(service_name).append(
+                content_id, seq, priority, uid, weight)
+
+    def _queue(self, service_name):
+        """ Return the ServiceQueue of a Service, with its current slots """
+        queue = self._queues.get(service_name, None)
+        if queue is None:
+            queue = self._queues[service_name] = ServiceQueue()
+        queue.slots = self.slots.get(service_name, 1)
+        return queue
+
+    def extend(self, items):
+        """ Enqueue a list of items atomically """
+        with self._lock:
+            return [self.append(*item) for item in items]
+
+    def head(self, service_name):
+        with self._lock:
+            return super().head(service_name)
+
+    def get_pos(self, content_id):
+        with self._lock:
+            service_name = self._services.get(content_id, None)
+            if service_name is None:
+                return -1
+            return self._queues[service_name].position(content_id)
+
+    def remove(self, content_id):
+        with self._lock:
+            service_name = self._services.pop(content_id, None)
+            if service_name is not None:
+                self._queue(service_name).remove(content_id)
+                self._notify(content_id)
+                self._notify_head(service_name)
+            return service_name
+
+    def wait(self, content_id, timeout=None):
+        with self._lock:
+            if self._has_turn(content_id):
+                return self.get_pos(content_id)
+            event = self._events.setdefault(content_id, Event())
+        event.wait(timeout)
+        with self._lock:
+            if self._has_turn(content_id):
+                self._events.pop(content_id, None)
+            return self.get_pos(content_id)
+
+    def _has_turn(self, content_id):
+        service_name = self._services.get(content_id, None)
+        if service_name is None:
+            return True
+        queue_pos = self._queues[service_name].position(content_id)
+        return queue_pos < self.slots.get(service_name, 1)
+
+    def _notify(self, content_id):
+        event = self._events.pop(content_id, None)
+        if event:
+            event.set()
+
+    def _notify_head(self, service_name):
+        if not self._events:
+            return
+        for content_id in self.head(service_name):
+            self._notify(content_id)
+
+
+class SQLQueueStore(QueueStore):
+    """
+    Service Queues kept in SQL tables, shared by every process using the same
+    DB. Positions are indexed COUNT()s over (service_name, priority, seq) and
+    sequences come from a per Service counter row, incremented under its row
+    lock. No fair share support.
+    New entries get at most the lowest priority of the entries that have
+    their turn, so they are enqueued after them.
+    """
+    def __init__(self, db_uri, slots=None, poll_interval=0.1,
+                 engine_options=None):
+        super().__init__(slots)
+        self.poll_interval = poll_interval
+        self.engine = create_engine(db_uri, **(engine_options or {}))
+        self.metadata = MetaData()
+        self.entries = Table(
+            "queue_entry", self.metadata,
+            Column("content_id", Integer, primary_key=True),
+            Column("service_name", String(32), nullable=False),
+            Column("seq", Integer, nullable=False),
+            Column("priority", Integer, nullable=False, server_default="0"),
+            Index("ix_queue_entry_service_name_seq", "service_name", "seq"),
+            Index("ix_queue_entry_service_name_priority_seq",
+                  "service_name", "priority", "seq"))
+        self.counters = Table(
+            "queue_counter", self.metadata,
+            Column("service_name", String(32), primary_key=True),
+            Column("next_seq", Integer, nullable=False))
+        self.metadata.create_all(self.engine)
+        # Tables created before the priority column
+        with self.engine.begin() as conn:
+            columns = {c["name"] for c in
+                       inspect(conn).get_columns("queue_entry")}
+            if "priority" not in columns:
+                conn.execute(text("ALTER TABLE queue_entry ADD COLUMN "
+                                  "priority INTEGER NOT NULL DEFAULT 0"))
+            for index in self.entries.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+    def reserve(self, service_name):
+        c = self.counters.c
+        while True:
+            try:
+                with self.engine.begin() as conn:
+                    # The UPDATE locks the counter row until the commit
+                    updated = conn.execute(
+                        update(self.counters).where(
+                            c.service_name == service_name).values(
+                            next_seq=c.next_seq + 1)).rowcount
+                    if updated:
+                        return conn.execute(
+                            select(c.next_seq).where(
+                                c.service_name == service_name)
+                        ).scalar() - 1
+                    conn.execute(insert(self.counters).values(
+                        service_name=service_name, next_seq=1))
+                    return 0
+            except IntegrityError:
+                # Another process created the counter first
+                continue
+
+    def append(self, service_name, content_id, seq=None, priority=0,
+               uid=None):
+        if self.service(content_id) is None:
+            if seq is None:
+                seq = self.reserve(service_name)
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(insert(self.entries).values(
+                        content_id=content_id,
+                        service_name=service_name,
+                        seq=seq,
+                        priority=self._cap_priority(conn, service_name,
+                                                    priority or 0)))
+            except IntegrityError:
+                pass
+        return self.get_pos(content_id)
+
+    def extend(self, items):
+        rows = []
+        for item in items:
+            service_name, content_id = item[0], item[1]
+            seq = item[2] if len(item) > 2 else None
+            priority = item[3] if len(item) > 3 else 0
+            if self.service(content_id) is not None:
+                continue
+            if seq is None:
+                seq = self.reserve(service_name)
+            rows.append({"content_id": content_id,
+                         "service_name": service_name,
+                         "seq": seq,
+                         "priority": priority or 0})
+        if rows:
+            with self.engine.begin() as conn:
+                caps = dict()
+                for row in rows:
+                    service_name = row["service_name"]
+                    if service_name not in caps:
+                        caps[service_name] = self._cap_priority(
+                            conn, service_name, None)
+                    if caps[service_name] is not None:
+                        row["priority"] = min(row["priority"],
+                                              caps[service_name])
+                conn.execute(insert(self.entries), rows)
+        return [self.get_pos(item[1]) for item in items]
+
+    def _cap_priority(self, conn, service_name, priority):
+        """
+        Return priority capped to the lowest priority of the entries that
+        have their turn (priority=None returns that cap, None if no entry)
+        """
+        e = self.entries.c
+        window = select(e.priority).where(
+            e.service_name == service_name).order_by(
+            e.priority.desc(), e.seq).limit(
+            self.slots.get(service_name, 1)).subquery()
+        cap = conn.execute(select(func.min(window.c.priority))).scalar()
+        if priority is None:
+            return cap
+        return priority if cap is None else min(priority, cap)
+
+    def get_pos(self, content_id):
+        e = self.entries.c
+        with self.engine.connect() as conn:
+            entry = conn.execute(
+                select(e.service_name, e.seq, e.priority).where(
+                    e.content_id == content_id)).first()
+            if entry is None:
+                return -1
+            return conn.execute(
+                select(func.count(e.content_id)).where(
+                    e.service_name == entry.service_name,
+                    or_(e.priority > entry.priority,
+                        and_(e.priority == entry.priority,
+                             e.seq < entry.seq)))
+            ).scalar()
+
+    def remove(self, content_id):
+        e = self.entries.c
+        with self.engine.begin() as conn:
+            service_name = conn.execute(
+                select(e.service_name).where(e.content_id == content_id)
+            ).scalar()
+            if service_name is not None:
+                conn.execute(delete(self.entries).where(
+                    e.content_id == content_id))
+            return service_name
+
+    def service(self, content_id):
+        e = self.entries.c
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(e.service_name).where(e.content_id == content_id)
+            ).scalar()
+
+    def size(self, service_name):
+        e = self.entries.c
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(func.count(e.content_id)).where(
+                    e.service_name == service_name)
+            ).scalar()
+
+    def content_ids(self, service_name, n=None):
+        e = self.entries.c
+        query = select(e.content_id).where(
+            e.service_name == service_name).order_by(e.priority.desc(),
+                                                     e.seq)
+        if n is not None:
+            query = query.limit(n)
+        with self.engine.connect() as conn:
+            return [row.content_id for row in conn.execute(query)]
+
+    def services(self):
+        e = self.entries.c
+        with self.engine.connect() as conn:
+            return [row.service_name for row in conn.execute(
+                select(e.service_name).distinct())]
+
+
+class RedisQueueStore(QueueStore):
+    """
+    Service Queues kept in Redis (or any client with the redis-py API),
+    shared by every process and host using the same server:
+    - a sorted set per Service, scored by sequence - priority * 2^40
+      (ZRANK is the position), exact for priorities within +-2^12
+      No fair share support. New entries get at most the lowest priority
+      of the entries that have their turn, so they are enqueued after them.
+    - a hash content_id -> service_name
+    - a counter per Service for the sequences (INCR)
+    """
+    def __init__(self, client, prefix="content_server", slots=None,
+                 poll_interval=0.1):
+        super().__init__(slots)
+        self.client = client
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+
+    def _key(self, *parts):
+        return ":".join((self.prefix, ) + parts)
+
+    @staticmethod
+    def _str(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def reserve(self, service_name):
+        return self.client.incr(self._key("seq", service_name)) - 1
+
+    def append(self, service_name, content_id, seq=None, priority=0,
+               uid=None):
+        if seq is None:
+            seq = self.reserve(service_name)
+        priority = priority or 0
+        window = self.client.zrange(self._key("queue", service_name),
+                                    0, self.slots.get(service_name, 1) - 1,
+                                    withscores=True)
+        if window:
+            priority = min(priority, -(int(window[-1][1]) // 2 ** 40))
+        pipe = self.client.pipeline()
+        pipe.hsetnx(self._key("services"), content_id, service_name)
+        pipe.zadd(self._key("queue", service_name),
+                  {content_id: seq - priority * 2 ** 40},
+                  nx=True)
+        pipe.sadd(self._key("service_names"), service_name)
+        pipe.execute()
+        return self.get_pos(content_id)
+
+    def get_pos(self, content_id):
+        service_name = self.service(content_id)
+        if service_name is None:
+            return -1
+        queue_pos = self.client.zrank(self._key("queue", service_name),
+                                      content_id)
+        return -1 if queue_pos is None else queue_pos
+
+    def remove(self, content_id):
+        service_name = self.service(content_id)
+        if service_name is None:
+            return None
+        pipe = self.client.pipeline()
+        pipe.zrem(self._key("queue", service_name), content_id)
+        pipe.hdel(self._key("services"), content_id)
+        removed = pipe.execute()
+        return service_name if removed[-1] else None
+
+    def service(self, content_id):
+        return self._str(self.client.hget(self._key("services"),
+                                          content_id))
+
+    def size(self, service_name):
+        return self.client.zcard(self._key("queue", service_name))
+
+    def content_ids(self, service_name, n=None):
+        return [int(content_id) for content_id in self.client.zrange(
+            self._key("queue", service_name),
+            0,
+            -1 if n is None else n - 1)]
+
+    def services(self):
+        return sorted(self._str(service_name) for service_name in
+                      self.client.smembers(self._key("service_names")))
@@ -0,0 +1,94 @@
+import os
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+
+class StatusIndex:
+    """
+    In-memory view of the job statuses, to answer /status polls without
+    the DB. It listens to a ChangeFeed and keeps:
+    - a version per UID, changed by every add/update/remove of its contents
+    - the contents of each UID that may still be queued
+    - the UID of the last max_owners contents seen (LRU)
+    The ETag of a status response is a digest of the versions of its UIDs
+    and the current positions of their queued contents, so it is validated
+    with no DB access. Changes of contents whose UID is unknown change the
+    epoch, shared by every digest.
+    """
+    def __init__(self, max_owners=100000):
+        self.max_owners = max_owners
+        self._lock = Lock()
+        self._boot = os.urandom(8).hex()
+        self._counter = 0
+        self._epoch = 0
+        self._versions = dict()
+        self._owners = OrderedDict()
+        self._pending = dict()
+
+    def __call__(self, kind, content_ids, uid, service_name):
+        """ ChangeFeed listener """
+        if kind == "add":
+            self.learn(uid, content_ids, content_ids, changed=True)
+        elif kind in ("update", "remove"):
+            self.changed(content_ids, removed=kind == "remove")
+
+    def learn(self, uid, content_ids, pending=(), changed=False):
+        """
+        Record the contents of a UID, and which of them are pending
+        (changed=True for new contents, changing the version of the UID)
+        """
+        with self._lock:
+            if changed:
+                self._bump(uid)
+            for content_id in content_ids:
+                self._owners[content_id] = uid
+                self._owners.move_to_end(content_id)
+            if pending:
+                self._pending.setdefault(uid, set()).update(pending)
+            while len(self._owners) > self.max_owners:
+                self._owners.popitem(last=False)
+
+    def changed(self, content_ids, removed=False):
+        with self._lock:
+            for content_id in content_ids:
+                uid = self._owners.get(content_id, None)
+                if uid is None:
+                    self._epoch += 1
+                    continue
+                self._bump(uid)
+                if removed:
+                    del self._owners[content_id]
+                    self._pending.get(uid, set()).discard(content_id)
+
+    def owner(self, content_id):
+        with self._lock:
+            return self._owners.get(content_id, None)
+
+    def pending(self, uid):
+        """ Return the contents of a UID that may still be queued """
+        with self._lock:
+            return list(self._pending.get(uid, ()))
+
+    def done(self, uid, content_ids):
+        """ Forget contents that left the Queue """
+        with self._lock:
+            pending = self._pending.get(uid, None)
+            if pending is not None:
+                pending.difference_update(content_ids)
+                if not pending:
+                    del self._pending[uid]
+
+    def digest(self, uids, positions):
+        """ Digest of the versions of uids and {content_id: position} """
+        with self._lock:
+            state = (self._boot,
+                     self._epoch,
+                     sorted((uid, self._versions.get(uid, 0))
+                            for uid in uids),
+                     sorted(positions.items()))
+        return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()[:20]
+
+    def _bump(self, uid):
+        self._counter += 1
+        self._versions[uid] = self._counter
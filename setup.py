@@ -14,10 +14,19 @@ setup(
     author='SingularityNET Foundation',
     author_email='info@singularitynet.io',
     description='SingularityNET Content Server',
-    python_requires='>=3.5',
+    python_requires='>=3.6',
     install_requires=[
         'Flask',
-        'Flask-SQLAlchemy'
+        'Flask-SQLAlchemy',
+        'SQLAlchemy>=1.4'
     ],
+    extras_require={
+        'async': ['aiosqlite'],
+        'redis': ['redis>=3'],
+        'waitress': ['waitress'],
+        'gunicorn': ['gunicorn'],
+        'uvicorn': ['uvicorn', 'asgiref'],
+        'zstd': ['zstandard']
+    },
     include_package_data=True
 )
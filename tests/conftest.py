@@ -0,0 +1,13 @@
+import pytest
+
+from content_server import ContentServer
+
+
+@pytest.fixture
+def cs(tmp_path):
+    """ ContentServer on a new SQLite DB """
+    server = ContentServer(config={
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(
+            tmp_path / "content.db")})
+    server.create(drop=True)
+    return server
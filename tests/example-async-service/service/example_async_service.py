@@ -161,12 +161,10 @@ class CalculatorServicer(grpc_bt_grpc.CalculatorServicer):
         return result
 
     @staticmethod
-    def process_request(content_id, rpc_method, **kwargs):
+    def process_request(uid, content_id, rpc_method, **kwargs):
         # Waiting for queue
-        queue_pos = cs.queue_get_pos(content_id)
-        while queue_pos != 0:
-            queue_pos = cs.queue_get_pos(content_id)
-            time.sleep(1)
+        if cs.wait_for_turn(content_id) < 0:
+            return
     
         delay = randint(10, 30)
         log.info("Fake Processing Delay: {}".format(delay))
@@ -200,17 +198,16 @@ class CalculatorServicer(grpc_bt_grpc.CalculatorServicer):
 
     @staticmethod
     def process_request_post(content_id, rpc_method, request):
-        # Waiting for queue
-        r = requests.post("http://{}:{}/queue_get_pos".format(cs_host,
-                                                               cs_port),
-                          data={"content_id": content_id})
-        queue_pos = int(r.text)
-        while queue_pos != 0:
+        # Waiting for queue (long-poll, 30s per request)
+        queue_pos = 1
+        while queue_pos > 0:
             r = requests.post("http://{}:{}/queue_get_pos".format(cs_host,
                                                                    cs_port),
-                              data={"content_id": content_id})
+                              data={"content_id": content_id,
+                                    "timeout": 30})
             queue_pos = int(r.text)
-            time.sleep(1)
+        if queue_pos != 0:
+            return
     
         delay = randint(10, 30)
         log.info("Fake Processing Delay: {}".format(delay))
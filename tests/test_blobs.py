@@ -0,0 +1,12 @@
+import pytest
+
+from content_server import ContentServer
+
+
+def test_no_blob_folder_keeps_payloads_inline():
+    cs = ContentServer(config={"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    assert cs.blobs.folder is None
+    assert cs.blobs.store("x") == {"content": "x", "content_ref": None}
+    assert list(cs.blobs.keys()) == []
+    with pytest.raises(ValueError):
+        cs.blobs.store("x" * (cs.blobs.inline_limit + 1))
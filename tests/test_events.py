@@ -0,0 +1,45 @@
+import json
+
+from content_server import _event_stream
+
+
+def _logged_client(cs):
+    client = cs.app.test_client()
+    with client.session_transaction() as session:
+        session["logged"] = True
+        session["uids"] = [cs.admin_pwd]
+    return client
+
+
+def test_event_streams_are_capped(cs):
+    client = _logged_client(cs)
+    cs.max_event_streams = 0
+    assert client.get("/api/events").status_code == 503
+    cs.max_event_streams = None
+    response = client.get("/api/events")
+    assert response.status_code == 200
+    response.close()
+
+
+def test_positions_stop_past_max_positions(cs, monkeypatch):
+    content_ids = [cs.add(uid="a")[1] for _ in range(10)]
+    calls = []
+    queue_get_pos = cs.queue_get_pos
+
+    def counting_queue_get_pos(content_id):
+        calls.append(content_id)
+        return queue_get_pos(content_id)
+
+    with cs.app.app_context():
+        subscription = cs.feed.subscribe()
+        stream = _event_stream(cs, subscription, None, max_positions=3)
+        assert next(stream) == "retry: 3000\n\n"
+        monkeypatch.setattr(cs, "queue_get_pos", counting_queue_get_pos)
+        cs.queues.remove(content_ids[0])
+        cs.feed.publish("queue", service_name="test_service")
+        frame = next(stream)
+        stream.close()
+    assert frame.startswith("event: reload\n")
+    assert json.loads(frame.split("data: ")[1]) == {}
+    # The removed entry, then max_positions + 1 moved ones
+    assert calls == content_ids[:5]
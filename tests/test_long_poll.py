@@ -0,0 +1,19 @@
+import time
+
+
+def test_long_polls_past_the_cap_answer_right_away(cs):
+    cs.add()
+    _, content_id = cs.add()
+    client = cs.app.test_client()
+    cs.max_long_polls = 0
+    start = time.time()
+    response = client.post("/queue_get_pos",
+                           data={"content_id": content_id, "timeout": 5})
+    assert response.get_data(as_text=True) == "1"
+    assert time.time() - start < 1
+
+    cs.max_long_polls = None
+    response = client.post("/queue_get_pos",
+                           data={"content_id": content_id, "timeout": 0.1})
+    assert response.get_data(as_text=True) == "1"
+    assert cs._long_polls == 0
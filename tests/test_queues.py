@@ -0,0 +1,176 @@
+import random
+import threading
+
+import pytest
+
+from content_server import ContentServer
+from content_server.queues import ServiceQueue, MemoryQueueStore, \
+    SQLQueueStore, RedisQueueStore
+
+
+@pytest.fixture(params=["memory", "sql", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryQueueStore()
+    if request.param == "sql":
+        return SQLQueueStore("sqlite:///{}".format(tmp_path / "queues.db"),
+                             poll_interval=0.01)
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisQueueStore(fakeredis.FakeRedis(), poll_interval=0.01)
+
+
+# ============================ QueueStores ====================================
+def test_fifo_positions(store):
+    for content_id in range(1, 6):
+        assert store.append("S", content_id) == content_id - 1
+    assert store.size("S") == 5
+    assert store.content_ids("S") == [1, 2, 3, 4, 5]
+    assert store.content_ids("S", 2) == [1, 2]
+    assert [store.get_pos(c) for c in range(1, 6)] == [0, 1, 2, 3, 4]
+    assert store.get_pos(6) == -1
+
+
+def test_services_are_separate(store):
+    store.extend([("A", 1), ("B", 2), ("A", 3)])
+    assert sorted(store.services()) == ["A", "B"]
+    assert store.service(3) == "A"
+    assert store.service(4) is None
+    assert store.get_pos(2) == 0
+    assert store.get_pos(3) == 1
+
+
+def test_remove(store):
+    store.extend([("S", 1), ("S", 2), ("S", 3)])
+    assert store.remove(2) == "S"
+    assert store.remove(2) is None
+    assert store.content_ids("S") == [1, 3]
+    assert store.get_pos(3) == 1
+    assert store.get_pos(2) == -1
+
+
+def test_append_is_idempotent(store):
+    store.append("S", 1)
+    store.append("S", 2)
+    store.append("S", 1)
+    assert store.content_ids("S") == [1, 2]
+
+
+def test_reserved_sequences(store):
+    store.append("S", 0)
+    first = store.reserve("S")
+    second = store.reserve("S")
+    assert second > first
+    # Enqueued in the order of their sequences, not of the appends
+    store.append("S", 2, second)
+    store.append("S", 1, first)
+    assert store.content_ids("S") == [0, 1, 2]
+
+
+def test_priorities(store):
+    store.append("S", 1)
+    store.append("S", 2, priority=5)
+    store.append("S", 3, priority=-1)
+    store.append("S", 4, priority=5)
+    store.append("S", 5)
+    # 1 had its turn, the others follow by priority
+    assert store.content_ids("S") == [1, 2, 4, 5, 3]
+    assert store.get_pos(3) == 4
+
+
+def test_entries_with_turn_keep_it(store):
+    store.slots["S"] = 2
+    store.extend([("S", 1), ("S", 2), ("S", 3)])
+    store.append("S", 4, priority=5)
+    assert store.content_ids("S", 2) == [1, 2]
+    assert store.get_pos(4) >= 2
+    store.remove(1)
+    third = store.content_ids("S", 2)[1]
+    store.append("S", 5, priority=9)
+    assert store.content_ids("S", 2) == [2, third]
+
+
+def test_head_and_slots(store):
+    store.slots["S"] = 2
+    store.extend([("S", 1), ("S", 2), ("S", 3)])
+    assert store.head("S") == [1, 2]
+    assert store.wait(2, timeout=0) == 1
+    assert store.wait(3, timeout=0.05) == 2
+
+
+def test_wait_for_turn(store):
+    store.extend([("S", 1), ("S", 2)])
+    positions = []
+    waiter = threading.Thread(
+        target=lambda: positions.append(store.wait(2, timeout=5)))
+    waiter.start()
+    store.remove(1)
+    waiter.join()
+    assert positions == [0]
+    assert store.wait(3, timeout=0) == -1
+
+
+def test_fair_share():
+    store = MemoryQueueStore()
+    store.fair_share = True
+    store.weights = {"b": 2}
+    for content_id in (1, 2, 3):
+        store.append("S", content_id, uid="a")
+    for content_id in (4, 5, 6):
+        store.append("S", content_id, uid="b")
+    # One entry of "a" per round, two of "b"
+    assert store.content_ids("S") == [1, 4, 5, 2, 6, 3]
+
+
+def test_fair_share_keeps_turns():
+    store = MemoryQueueStore(slots={"S": 2})
+    store.fair_share = True
+    for content_id in (1, 2, 3):
+        store.append("S", content_id, uid="a")
+    store.append("S", 4, uid="b")
+    assert store.content_ids("S") == [1, 2, 4, 3]
+
+
+def test_content_server_keeps_store_settings(tmp_path):
+    store = MemoryQueueStore(slots={"S": 4})
+    store.fair_share = True
+    store.weights = {"a": 2}
+    cs = ContentServer(queue_store=store, workers={"T": 2}, config={
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(
+            tmp_path / "content.db")})
+    assert store.slots == {"S": 4, "T": 2}
+    assert cs.workers is store.slots
+    assert store.fair_share
+    assert store.weights == {"a": 2}
+
+
+# ============================ ServiceQueue ===================================
+@pytest.mark.parametrize("fair_share", [False, True])
+def test_service_queue_matches_sorted_keys(fair_share):
+    rng = random.Random(fair_share)
+    queue = ServiceQueue()
+    # Small blocks to split and merge them often
+    queue._load = 4
+    keys = dict()
+    next_id = 0
+    for _ in range(3000):
+        if keys and rng.random() < 0.4:
+            content_id = rng.choice(list(keys))
+            assert queue.remove(content_id)
+            del keys[content_id]
+        else:
+            next_id += 1
+            priority = rng.choice([0, 0, 0, 1, 5, -2])
+            uid = rng.choice("abc") if fair_share else None
+            queue.append(next_id, priority=priority, uid=uid,
+                         weight=1 if fair_share else None)
+            keys[next_id] = queue._keys[next_id]
+        expected = [key[-1] for key in sorted(keys.values())]
+        assert list(queue) == expected
+        assert len(queue) == len(expected)
+        for content_id in rng.sample(expected, min(5, len(expected))):
+            assert queue.position(content_id) == expected.index(content_id)
+        assert queue.head(3) == expected[:3]
+        if not fair_share:
+            # Brute force: by priority, then FIFO
+            order = sorted(keys, key=lambda c: (keys[c][1], keys[c][3]))
+            assert expected == order
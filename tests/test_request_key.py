@@ -0,0 +1,66 @@
+import time
+
+
+def test_pending_job_is_reused(cs):
+    _, source = cs.add(uid="a", request_key="K")
+    _, linked = cs.add(uid="b", request_key="K")
+    assert cs.get_job(linked).source_id == source
+    assert cs.queues.size("test_service") == 1
+    assert cs.queue_get_pos(linked) == cs.queue_get_pos(source) == 0
+
+    cs.update(source, queue_pos=-1, expiration="1h", content="result")
+    job = cs.get_job(linked)
+    assert (job.queue_pos, job.content) == (-1, "result")
+
+
+def test_ready_result_is_reused(cs):
+    _, source = cs.add(request_key="K")
+    cs.update(source, queue_pos=-1, expiration="1h", content="result")
+    _, linked = cs.add(request_key="K")
+    job = cs.get_job(linked)
+    assert (job.source_id, job.queue_pos, job.content) == \
+        (source, -1, "result")
+
+
+def test_error_is_not_reused(cs):
+    _, source = cs.add(request_key="K")
+    _, linked = cs.add(request_key="K")
+    cs.update(source, queue_pos=-2)
+    assert cs.get_job(linked).queue_pos == -2
+    _, retry = cs.add(request_key="K")
+    assert cs.get_job(retry).source_id is None
+    assert cs.queue_get_pos(retry) == 0
+
+
+def test_removed_source_promotes_first_link(cs):
+    _, source = cs.add(uid="a", request_key="K")
+    _, first = cs.add(uid="b", request_key="K")
+    _, second = cs.add(uid="c", request_key="K")
+    cs.remove(content_id=source)
+
+    assert cs.get_job(first).source_id is None
+    assert cs.queue_get_pos(first) == 0
+    assert cs.get_job(second).source_id == first
+    assert cs.queue_get_pos(second) == 0
+    # The request_key moved to the promoted job
+    _, late = cs.add(uid="d", request_key="K")
+    assert cs.get_job(late).source_id == first
+
+    cs.update(first, queue_pos=-1, expiration="1h", content="result")
+    for content_id in (second, late):
+        job = cs.get_job(content_id)
+        assert (job.queue_pos, job.content) == (-1, "result")
+
+
+def test_swept_result_is_forgotten(cs):
+    _, source = cs.add(request_key="K")
+    cs.update(source, queue_pos=-1, expiration="1s", content="result")
+    time.sleep(1.1)
+    assert cs.sweep() == (1, 1)
+
+    # Ids of deleted contents are not reused
+    _, other = cs.add()
+    assert other != source
+    _, retry = cs.add(request_key="K")
+    assert cs.get_job(retry).source_id is None
+    assert cs.queue_get_pos(retry) == 1
@@ -0,0 +1,57 @@
+from content_server import ContentServer
+from content_server.queues import SQLQueueStore
+
+
+def _poll(client, etag=None, **args):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get("/status", query_string=args, headers=headers)
+
+
+def test_unchanged_poll_is_not_modified(cs):
+    uid, _ = cs.add(uid="a")
+    cs.add(uid="a")
+    client = cs.app.test_client()
+    response = _poll(client, uid=uid)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    response = _poll(client, etag, uid=uid)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_etag_changes_with_queue_moves_and_updates(cs):
+    _, first = cs.add(uid="a")
+    _, second = cs.add(uid="b")
+    client = cs.app.test_client()
+    etag = _poll(client, content_id=second).headers["ETag"]
+
+    cs.remove(content_id=first)
+    response = _poll(client, etag, content_id=second)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    etag = response.headers["ETag"]
+
+    cs.update(second, queue_pos=0, message="started")
+    response = _poll(client, etag, content_id=second)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_no_etag_for_unknown_contents(cs):
+    cs.add(uid="a")
+    response = _poll(cs.app.test_client(), content_id=999)
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+
+
+def test_no_etag_with_a_shared_store(tmp_path):
+    cs = ContentServer(
+        queue_store=SQLQueueStore(
+            "sqlite:///{}".format(tmp_path / "queues.db")),
+        config={"SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(
+            tmp_path / "content.db")})
+    cs.create(drop=True)
+    uid, _ = cs.add(uid="a")
+    response = _poll(cs.app.test_client(), uid=uid)
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
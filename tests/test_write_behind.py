@@ -0,0 +1,60 @@
+import pytest
+
+from content_server import Content, db
+
+
+@pytest.fixture
+def buffered(cs):
+    """ ContentServer whose updates are only written by flush() """
+    cs.flush_interval = 3600
+    return cs
+
+
+def _row(cs, content_id):
+    with cs.app.app_context():
+        content = db.session.get(Content, content_id)
+        row = (content.queue_pos, content.message)
+        db.session.remove()
+    return row
+
+
+def test_updates_are_coalesced(buffered):
+    _, content_id = buffered.add()
+    buffered.update(content_id, queue_pos=0, message="first")
+    buffered.update(content_id, queue_pos=0, message="second")
+    assert list(buffered._pending) == [content_id]
+    assert _row(buffered, content_id)[1] != "second"
+    assert buffered.flush() == 1
+    assert _row(buffered, content_id) == (0, "second")
+    assert buffered.flush() == 0
+
+
+@pytest.mark.parametrize("queue_pos", [-1, -2])
+def test_final_states_are_written_right_away(buffered, queue_pos):
+    _, content_id = buffered.add()
+    _, other_id = buffered.add()
+    buffered.update(other_id, queue_pos=0, message="waiting")
+    buffered.update(content_id, queue_pos=queue_pos, message="done",
+                    expiration="1h", content="result")
+    # Written with the other buffered updates
+    assert buffered._pending == {}
+    assert _row(buffered, content_id) == (queue_pos, "done")
+    assert _row(buffered, other_id) == (0, "waiting")
+
+
+def test_failed_flush_is_buffered_again(buffered, monkeypatch):
+    _, content_id = buffered.add()
+    buffered.update(content_id, queue_pos=0, message="first")
+
+    def failing_commit():
+        # An update buffered during the flush wins over the failed one
+        buffered.update(content_id, queue_pos=0, message="second")
+        raise RuntimeError("DB down")
+
+    monkeypatch.setattr(db.session, "commit", failing_commit)
+    with pytest.raises(RuntimeError):
+        buffered.flush()
+    monkeypatch.undo()
+    assert buffered._pending[content_id]["message"] == "second"
+    assert buffered.flush() == 1
+    assert _row(buffered, content_id) == (0, "second")